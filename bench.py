@@ -0,0 +1,287 @@
+#!/usr/bin/python3
+'''
+    Benchmark the whole pipeline on a synthetic cohort.
+    make_cohort writes a tree shaped like the real one:
+        anonymiseddata/Anon-XXX-submit-YYYY-MM-DD-HH-MM-SS-NN.txt
+        classrepdistributed/, johnnyscode/ (the specials)
+    with a few submissions per student per assignment, and some
+    plagiarised files (copies of another student's, with the names changed).
+    run_benchmark then points defs at that tree, and times each stage:
+    ingestion, scoring (each metric and process), the specials,
+    reading/writing the results, cliques and silhouette.
+    Results are written as JSON, and check_regressions compares two runs.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import resource
+import tempfile
+import tracemalloc
+
+import defs
+import compare
+import specials
+import simstore
+import cliques
+import plot_graphs
+import preprocess
+
+_GATES = ['&', '|', '^']
+
+
+def _module(rng, vfilename, length, names):
+    '''Make up a Verilog module with about length lines'''
+    modname = vfilename[:-len(defs.VERILOG_SUFFIX)]
+    ports = names[:4]
+    lines = ['// ' + modname,
+             'module {}({});'.format(modname, ', '.join(ports)),
+             '  input {}, {}, {};'.format(*ports[:3]),
+             '  output {};'.format(ports[3])]
+    wires = names[4:]
+    lines.append('  wire {};'.format(', '.join(wires)))
+    while len(lines) < length - 1:
+        if rng.random() < 0.2:
+            lines.append('  always @(posedge {}) {} <= {}; // tick'.format(
+                ports[0], rng.choice(wires), rng.randint(0, 15)))
+        else:
+            lines.append('  assign {} = {} {} {};'.format(
+                rng.choice(wires), rng.choice(names), rng.choice(_GATES),
+                rng.choice(names)))
+    lines.append('endmodule')
+    return lines
+
+
+def _rename(lines, names, newnames):
+    '''Change the names in a file (as a plagiarist would)'''
+    renamed = []
+    for line in lines:
+        for old, new in zip(names, newnames):
+            line = line.replace(' ' + old, ' ' + new)
+        renamed.append(line)
+    return renamed
+
+
+def _names(rng, count):
+    return ['{}{}'.format(rng.choice('abcdwxyz'), i)
+            for i in rng.sample(range(1000), count)]
+
+
+def make_cohort(root, nstudents=100, nassign=11, length=40, plagiarism=0.1,
+                seed=1):
+    '''
+        Write a synthetic cohort under root: nstudents students, each
+        submitting (a few versions of) nassign assignments, each file
+        about length lines. A fraction plagiarism of the final versions
+        are copies of an earlier student's file, with the names changed.
+        Return (students, assignments), the lists to use in defs.
+    '''
+    rng = random.Random(seed)
+    students = ['%03d' % d for d in range(2, 2 + nstudents)]
+    assignments = (defs.assignments +
+                   ['Extra_{}.v'.format(i) for i in range(nassign)])[:nassign]
+    datadir = os.path.join(root, 'anonymiseddata')
+    os.makedirs(datadir, exist_ok=True)
+    jobnum = 0
+    for a in assignments:
+        finals = []
+        for s in students:
+            names = _names(rng, 8)
+            if finals and rng.random() < plagiarism:
+                final = _rename(rng.choice(finals), names, _names(rng, 8))
+            else:
+                final = _module(rng, a, length, names)
+            finals.append(final)
+            nversions = rng.randint(1, 3)
+            for version in range(nversions):
+                if version == nversions - 1:
+                    lines = final
+                else:  # An earlier, shorter attempt
+                    lines = final[:rng.randint(1, len(final))]
+                jobnum += 1
+                time = '2019-04-{:02d}-{:02d}-{:02d}-00'.format(
+                    1 + version, rng.randint(0, 23), rng.randint(0, 59))
+                filename = 'Anon-{}-submit-{}-{}{}'.format(
+                    s, time, jobnum, defs.JW_FILE_SUFFIX)
+                with open(os.path.join(datadir, filename), 'w') as fh:
+                    fh.write('submit job {} {}\n'.format(a, s))
+                    fh.write('\n'.join(lines))
+    for special_kind, dirname in [(defs.SPECIAL_CIRC, 'classrepdistributed'),
+                                  (defs.SPECIAL_INST, 'johnnyscode')]:
+        special_dir = os.path.join(root, dirname)
+        os.makedirs(special_dir, exist_ok=True)
+        for a in assignments:
+            with open(os.path.join(special_dir, a), 'w') as fh:
+                fh.write('\n'.join(_module(rng, a, length, _names(rng, 8))))
+    return (students, assignments)
+
+
+def use_tree(root, students, assignments):
+    '''
+        Point defs at the tree under root (see make_cohort).
+        Return the old settings, to give to restore_defs.
+    '''
+    old = {name: getattr(defs, name)
+           for name in ['DATAROOT', 'RESULTS_DIR', 'GRAPHS_DIR',
+                        'PAIRCACHE_FILE', 'students', 'assignments']}
+    old['special_src'] = dict(defs.special_src)
+    defs.DATAROOT = os.path.join(root, 'anonymiseddata')
+    defs.RESULTS_DIR = os.path.join(root, 'results')
+    defs.GRAPHS_DIR = os.path.join(defs.RESULTS_DIR, 'graphs')
+    defs.PAIRCACHE_FILE = os.path.join(defs.RESULTS_DIR, 'paircache.db')
+    defs.special_src[defs.SPECIAL_CIRC] = os.path.join(root,
+                                                       'classrepdistributed')
+    defs.special_src[defs.SPECIAL_INST] = os.path.join(root, 'johnnyscode')
+    defs.students = students
+    defs.assignments = assignments
+    os.makedirs(defs.GRAPHS_DIR, exist_ok=True)
+    return old
+
+
+def restore_defs(old):
+    '''Undo use_tree'''
+    for name, value in old.items():
+        setattr(defs, name, value)
+
+
+class Timer:
+    '''
+        Run and time each stage, recording the results in self.stages.
+        rss_growth_mb is how much the stage raised the peak memory of the
+        process: 0 if it stayed under the peak of an earlier stage, however
+        much it used. If trace, also record the peak memory allocated in
+        each stage itself (using tracemalloc, which makes everything
+        run slower).
+    '''
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.stages = []
+
+    def run(self, stage, func, *args, **kwargs):
+        '''Call func(*args, **kwargs), record how long it took'''
+        if self.trace:
+            tracemalloc.start()
+        maxrss = _maxrss_mb()
+        start = time.perf_counter()
+        value = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        row = {'stage': stage, 'seconds': round(seconds, 4),
+               'rss_growth_mb': round(_maxrss_mb() - maxrss, 1)}
+        if self.trace:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            row['peak_mb'] = round(peak / 2**20, 1)
+        self.stages.append(row)
+        print('# {:30s} {:8.3f}s'.format(stage, seconds), file=sys.stderr)
+        return value
+
+
+def _maxrss_mb():
+    '''Peak memory of this process so far (ru_maxrss is in KB on Linux)'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _load_all_results():
+    '''Read every results file, without using any earlier loads'''
+    simstore._loaded.clear()
+    for metric in defs.ALL_METRICS:
+        for proc in defs.ALL_PROCESS:
+            basename = metric + defs.FILENAME_SEP + proc
+            simstore.load_results(os.path.join(defs.RESULTS_DIR,
+                                               basename + defs.DATA_SUFFIX))
+            simstore.load_results(defs.special_filename(metric, proc))
+
+
+def _silhouette(basename, pnum):
+    totals = plot_graphs.read_diff_totals(basename, pnum)
+    return plot_graphs.calc_assignment_silhouette(totals, pnum)
+
+
+def run_benchmark(nstudents=100, nassign=11, length=40, plagiarism=0.1,
+                  seed=1, threshold=90, vectorise=True, trace=False,
+                  root=None, outpath=None):
+    '''
+        Make a cohort (in a temporary directory, unless root is given),
+        run each stage on it, and write the timings to outpath (as JSON).
+        Return the results (as a dict).
+    '''
+    params = {'nstudents': nstudents, 'nassign': nassign, 'length': length,
+              'plagiarism': plagiarism, 'seed': seed, 'threshold': threshold,
+              'vectorise': vectorise, 'trace': trace}
+    tmpdir = None
+    if root is None:
+        tmpdir = tempfile.TemporaryDirectory(prefix='bench-')
+        root = tmpdir.name
+    timer = Timer(trace)
+    (students, assignments) = timer.run(
+        'generate', make_cohort, root, nstudents, nassign, length,
+        plagiarism, seed)
+    old = use_tree(root, students, assignments)
+    try:
+        corpus = timer.run('ingest', preprocess.load_all, write=True)
+        for metric in defs.ALL_METRICS:
+            cmpfunc = compare.METRICS[metric].cmpfunc
+            for proc in defs.ALL_PROCESS:
+                basename = metric + defs.FILENAME_SEP + proc
+                timer.run('score-' + basename, compare.do_one_compare,
+                          basename, defs.latest_dir(proc), cmpfunc, corpus,
+                          vectorise)
+        timer.run('specials', specials.compare_specials, corpus=corpus)
+        timer.run('read-dat', _load_all_results)
+        timer.run('write-sim', simstore.convert_all)
+        timer.run('read-sim', _load_all_results)
+        pnum = {a: i for i, a in enumerate(defs.assignments)}
+        for metric in defs.ALL_METRICS:
+            for proc in defs.ALL_PROCESS:
+                basename = metric + defs.FILENAME_SEP + proc
+                timer.run('cliques-' + basename, cliques.get_cliques,
+                          metric, proc, threshold)
+                timer.run('silhouette-' + basename, _silhouette,
+                          basename, pnum)
+    finally:
+        restore_defs(old)
+        if tmpdir is not None:
+            tmpdir.cleanup()
+    results = {'params': params, 'python': sys.version.split()[0],
+               'when': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'total_seconds': round(sum(row['seconds']
+                                          for row in timer.stages), 4),
+               'stages': timer.stages}
+    if outpath is not None:
+        with open(outpath, 'w') as fh:
+            json.dump(results, fh, indent=1)
+        print('Benchmark results written to {}.'.format(outpath))
+    return results
+
+
+def check_regressions(basepath, newpath, slack=1.25, minimum=0.05):
+    '''
+        Compare two benchmark results files: print (and return) the stages
+        that took more than slack times as long in the new one.
+        Stages that took less than minimum seconds both times are ignored.
+    '''
+    with open(basepath) as fh:
+        base = {row['stage']: row for row in json.load(fh)['stages']}
+    with open(newpath) as fh:
+        new = {row['stage']: row for row in json.load(fh)['stages']}
+    slower = []
+    for stage, row in new.items():
+        if stage not in base:
+            continue
+        was, now = base[stage]['seconds'], row['seconds']
+        if max(was, now) >= minimum and now > slack * was:
+            slower.append((stage, was, now))
+            print('{:30s} {:8.3f}s -> {:8.3f}s'.format(stage, was, now))
+    return slower
+
+
+function = 1
+if __name__ == '__main__':
+    if function == 1:
+        run_benchmark(outpath='bench.json')
+    elif function == 2:
+        run_benchmark(nstudents=30, nassign=4, outpath='bench-small.json')
+    elif function == 3:
+        check_regressions('bench-base.json', 'bench.json')
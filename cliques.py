@@ -8,14 +8,14 @@
 import os
 import numpy as np
 
-import matplotlib.pyplot as plt
-
-from graphviz import Graph
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import defs
-# Make sure we only use Type 1 fonts:
-plt.rc('text', usetex=True)
-plt.rc('font', family='serif')
+import compare
+import figures
+import instrument
+import simstore
 
 
 def read_assignment_threshold(basename, threshold):
@@ -27,18 +27,19 @@ def read_assignment_threshold(basename, threshold):
             under: a mapping from pairs to sim value, when sim < threshold
     '''
     simfile = os.path.join(defs.RESULTS_DIR, basename+defs.DATA_SUFFIX)
+    store = simstore.load_results(simfile)
     over = {a: [] for a in defs.assignments}
     under = {a: {} for a in defs.assignments}
-    with open(simfile, 'r') as fh:
-        for line in fh:
-            s1, a1, s2, a2, sim = line.strip().replace('-', ' ').split()
-            sim = int(sim)
-            # Comparison within one project between different students
-            if a1 == a2 and s1 != s2:
-                if sim >= threshold:
-                    over[a1].append((s1, s2))
-                else:
-                    under[a1][(s1, s2)] = sim
+    for a in over:
+        # Comparison within one project between different students
+        if (a, a) not in store.blocks:
+            continue
+        block, mask = store.block(a), store.pair_mask(a)
+        rows, cols = store.rows[a], store.cols[a]
+        for i, j in zip(*np.nonzero(mask & (block >= threshold))):
+            over[a].append((rows[i], cols[j]))
+        for i, j in zip(*np.nonzero(mask & (block < threshold))):
+            under[a][(rows[i], cols[j])] = int(block[i, j])
     return (over, under)
 
 
@@ -50,54 +51,136 @@ def read_special_threshold(basename, pairs, threshold):
     '''
     basename = 'special' + defs.FILENAME_SEP + basename
     simfile = os.path.join(defs.RESULTS_DIR, basename+defs.DATA_SUFFIX)
-    with open(simfile, 'r') as fh:
-        for line in fh:
-            skind, p1, stu, p2, sim = line.strip().replace('-', ' ').split()
-            sim = int(sim)
-            if p1 == p2 and sim >= threshold:
-                pairs[p1].append((skind, stu))
+    store = simstore.load_results(simfile)
+    for a in pairs:
+        if (a, a) not in store.blocks:
+            continue
+        block = store.block(a)
+        over = (block != simstore.MISSING) & (block >= threshold)
+        for i, j in zip(*np.nonzero(over)):
+            pairs[a].append((store.rows[a][i], store.cols[a][j]))
     # No return, as pairs has been updared.
 
 
+class DisjointSet:
+    '''
+        Partition elements into cliques as related pairs are added,
+        using union-find (with path compression and union by size).
+        Pairs can be streamed in at any time, with add_pair.
+        Each clique keeps its members in the order they were added,
+        and cliques are ordered by when they were first made, so the
+        result is the same as adding the pairs to a list of lists.
+    '''
+    def __init__(self):
+        self.parent = {}
+        self.members = {}  # Only for roots: deque of clique members
+        self.made = {}     # Only for roots: when the clique was made
+        self.count = 0
+
+    def find(self, s):
+        '''Return the root of the clique s is in (or None)'''
+        if s not in self.parent:
+            return None
+        root = s
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[s] != root:  # Path compression
+            self.parent[s], s = root, self.parent[s]
+        return root
+
+    def _add_to(self, root, s, at_front=False):
+        '''Put a new element s in the clique with this root'''
+        self.parent[s] = root
+        if at_front:
+            self.members[root].appendleft(s)
+        else:
+            self.members[root].append(s)
+
+    def add_pair(self, s1, s2):
+        '''Record that s1 and s2 are in the same clique'''
+        r1, r2 = self.find(s1), self.find(s2)
+        if r1 is None and r2 is None:  # Neither in a clique, make new one
+            self.parent[s1] = s1
+            self.members[s1] = deque([s1])
+            self.made[s1] = self.count
+            self.count += 1
+            self._add_to(s1, s2)
+        elif r2 is None:  # Add s2 to s1's clique
+            self._add_to(r1, s2)
+        elif r1 is None:  # Add s1 to s2's clique
+            self._add_to(r2, s1)
+        elif r1 != r2:  # Already in different cliques, must merge these
+            m1, m2 = self.members.pop(r1), self.members.pop(r2)
+            made = self.made.pop(r1)
+            del self.made[r2]
+            # Union by size: hang the smaller tree under the bigger one
+            root, other = (r1, r2) if len(m1) >= len(m2) else (r2, r1)
+            self.parent[other] = root
+            # Merged clique is s1's members then s2's, but only copy the
+            # smaller deque of the two:
+            if len(m1) >= len(m2):
+                m1.extend(m2)
+                self.members[root] = m1
+            else:
+                m2.extendleft(reversed(m1))
+                self.members[root] = m2
+            self.made[root] = made
+
+    def add_pairs(self, pairlist):
+        '''Add each of the pairs in the list'''
+        for (s1, s2) in pairlist:
+            self.add_pair(s1, s2)
+
+    def cliques(self):
+        '''Return the cliques, sorted by size (biggest first)'''
+        roots = sorted(self.members, key=lambda r: self.made[r])
+        cliques = [list(self.members[r]) for r in roots]
+        return sorted(cliques, key=lambda c: len(c), reverse=True)
+
+
+@instrument.timed('make_cliques')
 def make_cliques(pairlist):
     '''
         Given a list of pairs that are related, partition the elements.
         Return a list of cliques, ie elements related by transitive closure.
         Cliques are sorted by size (biggest first).
     '''
-    cliques = []
-    for (s1, s2) in pairlist:
-        # First find out which (if any) cliques s1 and s2 are in already:
-        s1c, s2c = -1, -1
-        for i, c in enumerate(cliques):
-            if s1 in c:
-                s1c = i
-            if s2 in c:
-                s2c = i
-        # Now make sure they're put in the *same* clique:
-        if s1c == -1 and s2c == -1:   # Neither in a clique, make new one
-            cliques.append([s1, s2])
-        elif s1c >= 0 and s2c == -1:  # Add s2 to s1's clique
-            cliques[s1c].append(s2)
-        elif s1c == -1 and s2c >= 0:  # Add s1 to s2's clique
-            cliques[s2c].append(s1)
-        elif s1c != s2c:  # Already in different cliques, must merge these
-            cliques[s1c].extend(cliques[s2c])
-            del cliques[s2c]
-    # Sort the cliques by size, largest first:
-    return sorted(cliques, key=lambda c: len(c), reverse=True)
-
-
-def get_cliques(metric, proc, threshold, read_special=True):
+    dset = DisjointSet()
+    dset.add_pairs(pairlist)
+    return dset.cliques()
+
+
+def join_assignment_threshold(metric, proc, threshold, read_special=True):
+    '''
+        Same as read_assignment_threshold (and read_special_threshold),
+        but find the pairs with sim >= threshold directly from the source
+        files, without scoring every pair or needing the .dat files.
+        There are no 'under' values, so those dicts are empty.
+    '''
+    special_dir = defs.special_dir(proc) if read_special else None
+    over = compare.threshold_pairs(defs.latest_dir(proc),
+                                   compare.METRICS[metric].cmpfunc,
+                                   threshold, special_dir=special_dir)
+    under = {a: {} for a in defs.assignments}
+    return (over, under)
+
+
+def get_cliques(metric, proc, threshold, read_special=True, from_dat=True):
     '''
         Read data from file, make cliques, return cliques and others.
         - over: cliques (sim was >=threshold), indexed by assignments
         - under: pairs to sim (<threshold), indexed by assignments
+        If not from_dat, work out the over pairs from the source files
+        instead (faster, but under is then empty).
     '''
     basename = metric + defs.FILENAME_SEP + proc
-    (pairs, under) = read_assignment_threshold(basename, threshold)
-    if read_special:
-        read_special_threshold(basename, pairs, threshold)
+    if not from_dat:
+        (pairs, under) = join_assignment_threshold(metric, proc, threshold,
+                                                   read_special)
+    else:
+        (pairs, under) = read_assignment_threshold(basename, threshold)
+        if read_special:
+            read_special_threshold(basename, pairs, threshold)
     over = {assign: make_cliques(pairs[assign]) for assign in defs.assignments}
     return (over, under)
 
@@ -147,40 +230,130 @@ def who_did_what():
     return students
 
 
-def dotgraph_cliques(over, under, plot_assignment, colors=[]):
+# Ways to work out the sim between two cliques (see clique_sims):
+CLIQUE_SIMS = ['first', 'max', 'mean']
+
+
+def clique_sims(cliques, under, how='first'):
+    '''
+        Work out the sims between all the cliques of one assignment,
+        from the (under) sims between their members, in one go.
+        Return a matrix, with NaN where there is no sim. For two cliques:
+            first: the sim between their first members (representatives)
+            max: the biggest sim between any of their members
+            mean: the mean sim over all pairs of their members
+    '''
+    assert how in CLIQUE_SIMS, how
+    if len(cliques) == 0:
+        return np.zeros((0, 0))
+    members = [s for c in cliques for s in c]
+    index = {s: k for k, s in enumerate(members)}
+    sims = np.full((len(members), len(members)), np.nan)
+    if len(under) > 0:
+        rows = np.fromiter((index.get(s1, -1) for (s1, _) in under),
+                           dtype=np.int64, count=len(under))
+        cols = np.fromiter((index.get(s2, -1) for (_, s2) in under),
+                           dtype=np.int64, count=len(under))
+        vals = np.fromiter(under.values(), dtype=float, count=len(under))
+        known = (rows >= 0) & (cols >= 0)
+        sims[rows[known], cols[known]] = vals[known]
+    # A pair may only be in under one way round:
+    sims = np.where(np.isnan(sims), sims.T, sims)
+    # Each clique's members are together, starting at:
+    starts = np.cumsum([0] + [len(c) for c in cliques[:-1]])
+    if how == 'first':
+        return sims[np.ix_(starts, starts)]
+    if how == 'max':  # fmax ignores the NaNs
+        return np.fmax.reduceat(np.fmax.reduceat(sims, starts, axis=0),
+                                starts, axis=1)
+    known = ~np.isnan(sims)
+    totals = np.add.reduceat(np.add.reduceat(np.where(known, sims, 0),
+                                             starts, axis=0), starts, axis=1)
+    counts = np.add.reduceat(np.add.reduceat(known.astype(int),
+                                             starts, axis=0), starts, axis=1)
+    with np.errstate(invalid='ignore'):  # No sims at all gives NaN
+        return totals / counts
+
+
+def clique_edges(sims, top_k=None, floor=None):
+    '''
+        Pick the edges to draw between cliques, given their sims.
+        If floor, only keep the edges with sim >= floor;
+        if top_k, only keep an edge if it is one of the top_k
+        (biggest sims) for at least one of its two cliques.
+        Return a list of (i, j, sim), with i < j.
+    '''
+    n = len(sims)
+    upper = np.triu(np.ones((n, n), dtype=bool), k=1)
+    sims = np.where(upper, sims, sims.T)  # Use the i < j sims both ways
+    keep = ~np.isnan(sims) & ~np.eye(n, dtype=bool)
+    if floor is not None:
+        keep &= np.where(keep, sims, -np.inf) >= floor
+    if top_k is not None and n > 0:
+        ranked = np.argsort(-np.where(keep, sims, -np.inf), axis=1,
+                            kind='stable')[:, :top_k]
+        top = np.zeros((n, n), dtype=bool)
+        top[np.arange(n)[:, np.newaxis], ranked] = True
+        top &= keep
+        keep = top | top.T
+    return [(i, j, sims[i, j]) for i, j in zip(*np.nonzero(keep & upper))]
+
+
+def clique_dotgraph(assign, cliques, edges, colors=[], engine='dot'):
+    '''
+        Return the dot graph (not yet rendered) for one assignment:
+        the nodes are the cliques, and the edges are from clique_edges.
+    '''
+    basename = assign.replace(defs.VERILOG_SUFFIX, '')
+    outfile = os.path.join(defs.GRAPHS_DIR, basename+defs.DOT_SUFFIX)
+    dot = figures.graph(comment=basename, filename=outfile, engine=engine)
+    if engine != 'dot':  # The others let nodes overlap by default
+        dot.attr(overlap='false')
+    dot.attr('node', fontsize='20')
+    # Each clique is a single node in the graph:
+    for i, c in enumerate(cliques):
+        size = len(c)
+        nodeargs = {'label': '{}'.format(size),
+                    'height': '{}'.format(size/10),
+                    'width': '{}'.format(size/10)}
+        if len(colors) > 0:  # Then use the given colour:
+            nodeargs['style'] = 'filled'
+            nodeargs['fillcolor'] = colors[i]
+        # Else just colour the node with the CIRC version red:
+        elif defs.SPECIAL_CIRC in c:
+            nodeargs['style'] = 'filled'
+            nodeargs['fillcolor'] = 'red'
+        dot.node('n{}'.format(i), **nodeargs)
+    for (i, j, sim) in edges:
+        dot.edge('n{}'.format(i), 'n{}'.format(j),
+                 label='{:.0f}%'.format(sim))
+    return dot
+
+
+@instrument.timed('dotgraph_cliques')
+def dotgraph_cliques(over, under, plot_assignment, colors=[], how='first',
+                     top_k=None, floor=None, engine='dot', workers=1):
     '''
         Produce a dot graph where the nodes are the cliques,
         and the edges represent sim value between cliques.
         We write one dot graph for each assignment.
+        The sim between cliques is worked out as in clique_sims (how),
+        and for big graphs the edges can be pruned (top_k, floor).
+        The engine is the graphviz layout (sfdp is much faster for big
+        graphs); with workers > 1, the graphs are rendered at once.
     '''
+    dots = []
     for assign in plot_assignment:
-        basename = assign.replace(defs.VERILOG_SUFFIX, '')
-        outfile = os.path.join(defs.GRAPHS_DIR, basename+defs.DOT_SUFFIX)
-        dot = Graph(comment=basename, filename=outfile)
-        dot.attr('node', fontsize='20')
-        # Each clique is a single node in the graph:
-        for i, c in enumerate(over[assign]):
-            size = len(c)
-            nodeargs = {'label': '{}'.format(size),
-                        'height': '{}'.format(size/10),
-                        'width': '{}'.format(size/10)}
-            if len(colors) > 0:  # Then use the given colour:
-                nodeargs['style'] = 'filled'
-                nodeargs['fillcolor'] = colors[i]
-            # Else just colour the node with the CIRC version red:
-            elif defs.SPECIAL_CIRC in c:
-                nodeargs['style'] = 'filled'
-                nodeargs['fillcolor'] = 'red'
-            dot.node('n{}'.format(i), **nodeargs)
-            # Now put an edge to all the other nodes:
-            my_rep = c[0]  # Use first element as clique representative
-            for j in range(i+1, len(over[assign])):
-                ur_rep = over[assign][j][0]
-                if (my_rep, ur_rep) in under[assign]:
-                    sim = under[assign][(my_rep, ur_rep)]
-                    dot.edge('n{}'.format(i), 'n{}'.format(j),
-                             label='{}%'.format(sim))
-        dot.render()
+        sims = clique_sims(over[assign], under[assign], how)
+        edges = clique_edges(sims, top_k, floor)
+        dots.append(clique_dotgraph(assign, over[assign], edges, colors,
+                                    engine))
+    if workers > 1:  # The layout is done by graphviz, so threads will do
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda dot: dot.render(), dots))
+    else:
+        for dot in dots:
+            dot.render()
 
 
 def get_barchart_values(over):
@@ -207,11 +380,13 @@ def get_barchart_values(over):
     return maxcliques+2, mybars
 
 
-def barchart_cliques(over, save_to_file=False):
+def barchart_cliques(over, save_to_file=False, preview=False):
     '''
         Plot a stacked barchart showing the clique sizes,
         one stacked bar per assignment, one bar section per clique.
+        If preview, also save a PNG version (see figures.save).
     '''
+    plt = figures.pyplot()
     fig, ax = plt.subplots(nrows=1,
                            ncols=1,
                            figsize=(10, 10), sharey=True)
@@ -232,16 +407,15 @@ def barchart_cliques(over, save_to_file=False):
     last_horiz += one_bar(-1, last_horiz, color='white')
     last_horiz += one_bar(-2, last_horiz, color='gold', edgecolor='gray')
     # set style for the axes
-    ax.set_xticks(range(1+len(defs.assignments)))
-    ax.set_xticklabels([p.replace('.v', '').replace('_', '\\_')
+    ax.set_xticks(range(len(defs.assignments)))
+    ax.set_xticklabels([figures.escape(p.replace('.v', ''))
                         for p in defs.assignments], rotation=45)
     ax.set_ylabel('No of students')
     ax.set_ylim(0, len(defs.students))
     ax.yaxis.grid(True, linestyle='--', which='major', color='grey', alpha=.25)
     if save_to_file:
-        basename = 'barchart'
-        outfile = os.path.join(defs.GRAPHS_DIR, basename + defs.GRAPHS_SUFFIX)
-        plt.savefig(outfile, bbox_inches='tight')
+        figures.save(fig, 'barchart', preview, bbox_inches='tight')
+        plt.close(fig)
     else:
         plt.show()
     return plt.rcParams['axes.prop_cycle'].by_key()['color'].copy()
@@ -288,3 +462,7 @@ if __name__ == '__main__':
     elif function == 4:
         over, _ = get_cliques('jaccard', 'token', 100)
         count_buddies(over)
+    elif function == 5:  # Big cohorts: strongest links only, fast layout
+        over, under = get_cliques('jaccard', 'token', 50)
+        dotgraph_cliques(over, under, defs.assignments, how='max', top_k=3,
+                         engine='sfdp', workers=4)
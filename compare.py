@@ -9,12 +9,21 @@
     The simililarity perc is always an integer between 0 and 100.
 '''
 
+import io
 import os
+import sys
 import codecs
+import itertools
 
+from collections import OrderedDict, namedtuple
 from difflib import SequenceMatcher
 
 import defs
+import instrument
+
+# numpy, and the modules that use it (simmatrix, simjoin, minhash,
+# simstore, submissions), are only imported by the functions that
+# need them, so importing this module stays quick.
 
 
 class StudentRecord:
@@ -22,16 +31,24 @@ class StudentRecord:
         For a single student, store a dict of all their submissions.
         The dict is indexed by filename (i.e. assignment).
         Each submission is a (time, jobnum) pair.
+        The latest submission for each file is kept as they are added.
+        (For many students, a submissions.SubmissionIndex is much smaller.)
     '''
+    __slots__ = ('id', 'submits', 'latest')
+
     def __init__(self, id):
         self.id = id
         self.submits = {}
+        self.latest = {}
 
     def add_submit(self, vfile, time, jobnum):
         ''' Add a new submission to the list'''
         if vfile not in self.submits:
             self.submits[vfile] = []
         self.submits[vfile].append((time, jobnum))
+        # Same as the last after a (stable) sort, so later ties win:
+        if vfile not in self.latest or time >= self.latest[vfile][0]:
+            self.latest[vfile] = (time, jobnum)
 
     def sort_submits(self):
         '''Sor the suybmissions so most recent one for each file is last'''
@@ -39,40 +56,90 @@ class StudentRecord:
             submit_list.sort(key=lambda s: s[0])
 
 
-def get_students(dirname=defs.DATAROOT):
+def read_header(filepath, maxbytes=1024):
+    '''Return the first line of a file, reading at most maxbytes'''
+    with open(filepath, 'r') as fh:
+        return fh.readline(maxbytes)
+
+
+def scan_submissions(dirname):
+    '''
+        Go through the JW files in dirname, without reading them.
+        Yield (filename, student_id, kind, time, jobnum) for each one.
+    '''
+    with os.scandir(dirname) as entries:
+        for entry in entries:
+            filename = entry.name
+            if not filename.endswith(defs.JW_FILE_SUFFIX):
+                continue
+            # Trim suffix, split filename into fields:
+            field = filename[:-len(defs.JW_FILE_SUFFIX)].split(
+                defs.FILENAME_SEP)
+            student_id = field[1]  # anonymised student id
+            kind = field[2]
+            time = defs.FILENAME_SEP.join(field[3:9])
+            jobnum = field[9]
+            yield (filename, student_id, kind, time, jobnum)
+
+
+def read_submits(dirname=defs.DATAROOT, workers=8, chunk=1000):
+    '''
+        Go through all the JW files in dirname, and for each one
+        yield (student_id, vfile, time, jobnum), where vfile is None
+        if it isn't a submission (so every student is seen).
+        The first line of each submission (which names the Verilog file)
+        is read by a pool of workers threads, chunk files at a time,
+        so only one chunk of the files is held at once.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    print('Reading files from {}...'.format(os.path.basename(dirname)))
+    scan = scan_submissions(dirname)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            files = list(itertools.islice(scan, chunk))
+            if len(files) == 0:
+                break
+            # map gives the headers back in order, as they are read:
+            headers = pool.map(read_header,
+                               [os.path.join(dirname, filename)
+                                for (filename, _, kind, _, _) in files
+                                if kind == defs.SUBMIT])
+            for _, student_id, kind, time, jobnum in files:
+                vfile = None
+                if kind == defs.SUBMIT:
+                    vfile = next(headers).strip().split()[2]
+                yield (student_id, vfile, time, jobnum)
+
+
+def get_students(dirname=defs.DATAROOT, workers=8):
     '''
         Go through all the submissions and group them by student id.
         Return a dict mapping student id to StudentRecord objects.
     '''
     students = {}
-    _, _, files = next(os.walk(dirname))
-    files = [f for f in files if f.endswith(defs.JW_FILE_SUFFIX)]
-    print('Reading {} files from {}...'.format(
-            len(files), os.path.basename(dirname)))
-    for filename in files:
-        # Trim suffix, split filename into fields:
-        field = filename[:-len(defs.JW_FILE_SUFFIX)].split(defs.FILENAME_SEP)
-        student_id = field[1]  # anonymised student id
-        kind = field[2]
-        time = defs.FILENAME_SEP.join(field[3:9])
-        jobnum = field[9]
+    for student_id, vfile, time, jobnum in read_submits(dirname, workers):
         if student_id not in students:
             students[student_id] = StudentRecord(student_id)
-        if kind == defs.SUBMIT:
-            filepath = os.path.join(dirname, filename)
-            first_line = open(filepath, 'r').readline()
-            line_data = first_line.strip().split()
-            vfile = line_data[2]
+        if vfile is not None:
             students[student_id].add_submit(vfile, time, jobnum)
     return students
 
 
-def copy_file(source_dir, oldfilename, target_dir, newfilename,
-              omit_first=True):
+def get_index(dirname=defs.DATAROOT, workers=8):
     '''
-        Open oldfile, write to target_dir/newfile.
+        Go through all the submissions, return a SubmissionIndex of them
+        (a compact alternative to get_students).
+        The submissions go straight into the index, as they are read.
+    '''
+    import submissions
+    return submissions.make_index(read_submits(dirname, workers))
+
+
+def read_source(source_dir, oldfilename, omit_first=True):
+    '''
+        Read in a source file, return its lines, without any blank lines.
+        If omit_first, throw away the first line (JW's header).
     '''
-    # Read in the old file:
     oldfilepath = os.path.join(source_dir, oldfilename)
     with codecs.open(oldfilepath,
                      'r', encoding='utf-8', errors='ignore') as fh:
@@ -80,32 +147,67 @@ def copy_file(source_dir, oldfilename, target_dir, newfilename,
     if omit_first:  # Throw away first line
         lines = lines[1:]
     # Delete blank lines:
-    nblines = [nb for nb in lines if len(nb) > 0]
-    # Write out to the new file:
+    return [nb for nb in lines if len(nb) > 0]
+
+
+def write_lines(target_dir, newfilename, lines):
+    '''Write the lines to target_dir/newfile'''
     newfilepath = os.path.join(target_dir, newfilename)
     with open(newfilepath, 'w') as fh:
-        fh.write('\n'.join(nblines))
+        fh.write('\n'.join(lines))
 
 
-def save_latest(students, target_dir):
+def as_read(lines):
     '''
-        Save the latest version of each file for each student.
-        New file name looks like: target_dir/XXX-Filename.v
+        Return the lines as read_file would give them, if they had been
+        written by write_lines (so with newlines, and any \r translated).
+    '''
+    return io.StringIO('\n'.join(lines), newline=None).readlines()
+
+
+def copy_file(source_dir, oldfilename, target_dir, newfilename,
+              omit_first=True):
+    '''
+        Open oldfile, write to target_dir/newfile.
+    '''
+    write_lines(target_dir, newfilename,
+                read_source(source_dir, oldfilename, omit_first))
+
+
+def latest_files(students):
     '''
+        For the latest version of each file for each student,
+        yield (oldfilename, newfilename), where the new one is XXX-Filename.v
+        The students can be from get_students or get_index.
+    '''
+    if hasattr(students, 'latest_files'):  # A submissions.SubmissionIndex
+        yield from students.latest_files()
+        return
     for s in students.values():
-        s.sort_submits()
-        for vfilename, sublist in s.submits.items():
-            time, jobnum = sublist[-1]
+        for vfilename, (time, jobnum) in s.latest.items():
             oldfilename = 'Anon-{}-submit-{}-{}{}'.format(
                             s.id, time, jobnum, defs.JW_FILE_SUFFIX)
-            newfilename = s.id + defs.FILENAME_SEP + vfilename
-            copy_file(defs.DATAROOT, oldfilename,
-                      target_dir, newfilename, True)
+            yield (oldfilename, s.id + defs.FILENAME_SEP + vfilename)
+
+
+def save_latest(students, target_dir, workers=8):
+    '''
+        Save the latest version of each file for each student.
+        New file name looks like: target_dir/XXX-Filename.v
+        The files are copied by a pool of workers threads.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs = [pool.submit(copy_file, defs.DATAROOT, oldfilename,
+                            target_dir, newfilename, True)
+                for oldfilename, newfilename in latest_files(students)]
+        for job in jobs:
+            job.result()  # Pass on any errors
 
 
 def collect_latest():
-    students = get_students()
-    print('Read data for', len(students), 'students.')
+    students = get_index()
+    print('Read data for', len(students.student_ids), 'students.')
     orig_dir = defs.latest_dir('orig')
     print('Writing to', orig_dir)
     save_latest(students, orig_dir)
@@ -122,6 +224,32 @@ def sm_compare(f1, f2):
     return sm.ratio()
 
 
+def lcs_length(f1, f2):
+    '''
+        Return the length of the longest common subsequence of two lists,
+        using the bit-parallel algorithm of Allison & Dix (1986),
+        with a Python int as the bit-vector (one bit per element of f1).
+    '''
+    masks = {}
+    for i, line in enumerate(f1):
+        masks[line] = masks.get(line, 0) | (1 << i)
+    allbits = (1 << len(f1)) - 1
+    v = allbits
+    for line in f2:
+        u = v & masks.get(line, 0)
+        v = ((v + u) | (v - u)) & allbits
+    return len(f1) - bin(v).count('1')
+
+
+def lcs_compare(f1, f2):
+    '''
+        Compare two files using the longest common subsequence of lines.
+        Same form as SequenceMatcher's ratio (2*M/T), but with M=LCS,
+        so this is always an upper bound for sm_compare.
+    '''
+    return 2 * lcs_length(f1, f2) / (len(f1) + len(f2))
+
+
 def tversky(f1, f2, alpha, beta):
     '''Calculate the Tversky distance betwen two lists (as sets)'''
     sX = set(f1)
@@ -151,63 +279,846 @@ def count_common(f1, f2):
     return num_common
 
 
+# #####################################################################
+# Metric registry
+# #####################################################################
+
+# A metric is symmetric if cmpfunc(f1, f2) == cmpfunc(f2, f1) always.
+# Note SequenceMatcher.ratio() is *not*: it depends on the argument order.
+# A metric is a fraction if it is always between 0 and 1, so it can be
+# written as a percentage (to the .dat and .sim files); count_common isn't.
+Metric = namedtuple('Metric', ['name', 'cmpfunc', 'symmetric', 'fraction'])
+
+# All the metrics, indexed by name (as in defs.ALL_METRICS):
+METRICS = {}
+
+
+def register_metric(name, cmpfunc, symmetric, fraction=True):
+    '''Add a metric to the registry'''
+    METRICS[name] = Metric(name, cmpfunc, symmetric, fraction)
+
+
+def is_symmetric(cmpfunc):
+    '''Has this function been registered as a symmetric metric?'''
+    return any(m.symmetric for m in METRICS.values() if m.cmpfunc is cmpfunc)
+
+
+def check_fraction(cmpfunc):
+    '''Make sure the metric's values can be written as percentages'''
+    for m in METRICS.values():
+        if m.cmpfunc is cmpfunc and not m.fraction:
+            raise ValueError('the {} metric is not a fraction, so it cannot '
+                             'be written as a percentage'.format(m.name))
+
+
+register_metric('jaccard', jaccard, symmetric=True)
+register_metric('tversky', tv_asymmetric, symmetric=False)
+register_metric('sequence', sm_compare, symmetric=False)
+register_metric('common', count_common, symmetric=True, fraction=False)
+register_metric('lcs', lcs_compare, symmetric=True)
+
+
+# #####################################################################
+# Indexed versions of the set metrics
+# #####################################################################
+
+def line_id(line):
+    '''
+        A 63-bit ID for the line: the same line always gets the same ID
+        (in any process), with no table of lines to keep.
+    '''
+    import hashlib
+    digest = hashlib.blake2b(line.encode('utf-8', 'surrogatepass'),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, 'little') >> 1
+
+
+def line_ids(lines):
+    '''
+        Return a file as the sorted numpy array of its (distinct) line IDs,
+        so its size depends on the file, not on how many lines there are
+        in all the files. The set metrics then just intersect these.
+    '''
+    import numpy as np
+    distinct = set(lines)
+    return np.sort(np.fromiter((line_id(line) for line in distinct),
+                               dtype=np.int64, count=len(distinct)))
+
+
+def _num_common(ids1, ids2):
+    import numpy as np
+    return len(np.intersect1d(ids1, ids2, assume_unique=True))
+
+
+def tversky_ids(ids1, ids2, alpha, beta):
+    '''Calculate the Tversky distance betwen two arrays of line IDs'''
+    num_common = _num_common(ids1, ids2)
+    xmy = len(ids1) - num_common
+    ymx = len(ids2) - num_common
+    denom = num_common + (alpha * xmy) + (beta * ymx)
+    return num_common / denom
+
+
+def jaccard_ids(ids1, ids2):
+    '''Calculate the Jaccard distance betwen two arrays of line IDs'''
+    return tversky_ids(ids1, ids2, alpha=1, beta=1)
+
+
+def tv_asymmetric_ids(ids1, ids2):
+    '''Calculate the distance betwen two ID arrays as a prop of the first'''
+    return tversky_ids(ids1, ids2, alpha=1, beta=0)
+
+
+def count_common_ids(ids1, ids2):
+    '''Return the number of line IDs these arrays have in common'''
+    return _num_common(ids1, ids2)
+
+
+# Map each set metric to its version over arrays of line IDs:
+INDEXED_METRICS = {
+    jaccard: jaccard_ids,
+    tv_asymmetric: tv_asymmetric_ids,
+    count_common: count_common_ids,
+}
+
+# Map each set metric to its version over a matrix of common counts
+# (the name of the function in simmatrix):
+MATRIX_METRICS = {
+    jaccard: 'jaccard_matrix',
+    tv_asymmetric: 'tv_asymmetric_matrix',
+    count_common: 'count_common_matrix',
+}
+
+# Map each set metric to its candidate generator for threshold joins
+# (the name of the function in simjoin):
+JOIN_METRICS = {
+    jaccard: 'jaccard_candidates',
+    tv_asymmetric: 'tversky_candidates',
+}
+
+
+@instrument.timed('read_file')
 def read_file(dirname, filename):
+    instrument.count('files read')
     filepath = os.path.join(dirname, filename)
     with open(filepath, 'r') as fh:
         lines = fh.readlines()
     return lines
 
 
-def compare_all(dirname, myfilter, cmpfunc):
+def list_files(dirname, corpus=None):
+    '''
+        List the files in dirname, or (if the corpus has been given
+        files for dirname) the files given for it.
+    '''
+    if corpus is not None and dirname in corpus.listing:
+        return list(corpus.listing[dirname])
+    _, _, files = next(os.walk(dirname))
+    return files
+
+
+class Corpus:
+    '''
+        An in-memory store of file contents, indexed by file path.
+        Each file is read from disk once, and then shared by every
+        comparison that uses it (any metric, any process).
+        If maxsize is given, keep at most that many files in memory,
+        evicting the least-recently-used one when full.
+        Every file also has a sorted array of its line IDs (see line_ids).
+        Lines are interned, so a line that is in many files (e.g. endmodule)
+        is only kept once; it is freed when no file has it any more.
+        Files can also be given directly (see add_file), in which case
+        they are never read from disk (and need not be there at all).
+    '''
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.files = OrderedDict()
+        self.ids = {}
+        self.given = {}
+        self.listing = {}
+
+    def add_file(self, dirname, filename, lines):
+        '''Give the lines for dirname/filename, as read_file would'''
+        filepath = os.path.join(dirname, filename)
+        if filepath not in self.given:
+            self.listing.setdefault(dirname, []).append(filename)
+        self.given[filepath] = [sys.intern(line) for line in lines]
+        self.files.pop(filepath, None)  # Forget any older version
+        self.ids.pop(filepath, None)
+
+    def _load(self, dirname, filename):
+        '''Make sure this file is in memory, return its path'''
+        filepath = os.path.join(dirname, filename)
+        if filepath in self.files:
+            self.files.move_to_end(filepath)
+            return filepath
+        if filepath in self.given:
+            lines = self.given[filepath]
+        else:
+            lines = [sys.intern(line) for line in read_file(dirname, filename)]
+        self.files[filepath] = lines
+        self.ids[filepath] = line_ids(lines)
+        if self.maxsize is not None and len(self.files) > self.maxsize:
+            oldpath, _ = self.files.popitem(last=False)  # least-recently used
+            del self.ids[oldpath]
+        return filepath
+
+    def read_file(self, dirname, filename):
+        '''Return the lines in this file, reading from disk if necessary'''
+        return self.files[self._load(dirname, filename)]
+
+    def read_ids(self, dirname, filename):
+        '''Return the sorted array of (distinct) line IDs for this file'''
+        return self.ids[self._load(dirname, filename)]
+
+
+@instrument.timed('compare_all')
+def compare_all(dirname, myfilter, cmpfunc, corpus=None):
     ''' Compare the latest submission for a program for all students
         Do a full NxN comparison, in case cmpfunc is asymmetric.
+        File contents are read via the corpus (a new one if not given).
+        Set metrics are scored over the corpus line IDs instead of lines.
         Return a list of triples: (file1, file2, similarity)
     '''
-    # What progress intervals do you want printed (list of percentages)
-    progress = list(range(0, 100, 10))
-    _, _, files = next(os.walk(dirname))
+    if corpus is None:
+        corpus = Corpus()
+    symmetric = is_symmetric(cmpfunc)
+    if cmpfunc in INDEXED_METRICS:
+        cmpfunc = INDEXED_METRICS[cmpfunc]
+        read = corpus.read_ids
+    else:
+        read = corpus.read_file
+    files = list_files(dirname, corpus)
     files = [f for f in files if myfilter(f)]
+    progress = instrument.Progress(len(files), 'files')
     metrics = []
     for i, fn1 in enumerate(files):
-        if len(progress) > 0 and int(i*100/len(files)) == progress[0]:
-            print('{}%'.format(progress[0]), flush=True, end=' ')
-            progress = progress[1:]
-        lines1 = read_file(dirname, fn1)
-        if (not lines1) or len(lines1) == 0:
+        progress.update(i)
+        lines1 = read(dirname, fn1)
+        if len(lines1) == 0:
             continue
-        for fn2 in files:  # if symmetric, use files[i+1:]:
-            lines2 = read_file(dirname, fn2)
-            if (not lines2) or len(lines2) == 0:
+        # If symmetric, just do the upper triangle and mirror the sims:
+        for fn2 in (files[i:] if symmetric else files):
+            lines2 = read(dirname, fn2)
+            if len(lines2) == 0:
                 continue
             sim = round(cmpfunc(lines1, lines2) * 100)
             metrics.append((fn1, fn2, sim))
+            if symmetric and fn1 != fn2:
+                metrics.append((fn2, fn1, sim))
     return sorted(metrics, key=lambda t: t[0]+t[1])
 
 
-def do_one_compare(outfile, datadir, cmpfunc):
+def score_matrix(dir1, files1, dir2, files2, cmpfunc, corpus, rows=None):
+    '''
+        Compare every file in files1 against every file in files2,
+        all in one go, using a sparse matrix product of the line IDs.
+        Only works for the set metrics (those in MATRIX_METRICS).
+        If rows is given, only do those (indices of) files in files1.
+        Empty files are skipped, as in compare_all.
+        Return (files1, files2, sims): the files that were compared,
+        and the matrix of their sims (as integer percentages).
+    '''
+    import simmatrix
+    if rows is not None:
+        files1 = [files1[i] for i in rows]
+    ids1 = [corpus.read_ids(dir1, f) for f in files1]
+    ids2 = [corpus.read_ids(dir2, f) for f in files2]
+    files1 = [f for f, ids in zip(files1, ids1) if len(ids) > 0]
+    files2 = [f for f, ids in zip(files2, ids2) if len(ids) > 0]
+    ids1, ids2, num_ids = simmatrix.compact_ids(
+        [ids for ids in ids1 if len(ids) > 0],
+        [ids for ids in ids2 if len(ids) > 0])
+    counts = simmatrix.common_counts(ids1, ids2, num_ids)
+    matrix_metric = getattr(simmatrix, MATRIX_METRICS[cmpfunc])
+    return (files1, files2, simmatrix.percentages(matrix_metric(*counts)))
+
+
+def compare_matrix(dir1, files1, dir2, files2, cmpfunc, corpus, rows=None):
+    '''
+        Same as score_matrix, but
+        return an (unsorted) list of triples: (file1, file2, similarity)
+    '''
+    files1, files2, sims = score_matrix(dir1, files1, dir2, files2, cmpfunc,
+                                        corpus, rows)
+    sims = sims.tolist()
+    return [(fn1, fn2, sims[i][j])
+            for i, fn1 in enumerate(files1)
+            for j, fn2 in enumerate(files2)]
+
+
+def compare_join(dir1, files1, dir2, files2, cmpfunc, corpus, threshold,
+                 rows=None):
+    '''
+        Find the pairs of files in files1 and files2 with sim >= threshold,
+        for the set metrics (those in JOIN_METRICS), without scoring them all.
+        Candidate pairs come from simjoin, and are then checked exactly.
+        If rows is given, only do those (indices of) files in files1.
+        Return an (unsorted) list of triples: (file1, file2, similarity)
+    '''
+    if rows is not None:
+        files1 = [files1[i] for i in rows]
+    ids1 = [corpus.read_ids(dir1, f) for f in files1]
+    ids2 = [corpus.read_ids(dir2, f) for f in files2]
+    import simjoin
+    idfunc = INDEXED_METRICS[cmpfunc]
+    candidates = getattr(simjoin, JOIN_METRICS[cmpfunc])
+    metrics = []
+    for i, j in candidates([ids.tolist() for ids in ids1],
+                           [ids.tolist() for ids in ids2], threshold):
+        sim = round(idfunc(ids1[i], ids2[j]) * 100)
+        if sim >= threshold:
+            metrics.append((files1[i], files2[j], sim))
+    return metrics
+
+
+def compare_lsh(dir1, files1, dir2, files2, corpus, threshold,
+                bands=32, rows=4, seed=1):
+    '''
+        Approximate version of compare_join for jaccard: candidate pairs
+        come from MinHash/LSH over bands x rows hashes (see minhash),
+        and are then checked exactly. Some qualifying pairs may be missed.
+        Return an (unsorted) list of triples: (file1, file2, similarity)
+    '''
+    import minhash
+    files1 = [f for f in files1 if len(corpus.read_ids(dir1, f)) > 0]
+    files2 = [f for f in files2 if len(corpus.read_ids(dir2, f)) > 0]
+    if len(files1) == 0 or len(files2) == 0:
+        return []
+    sigs1 = minhash.signatures([corpus.read_ids(dir1, f) for f in files1],
+                               bands * rows, seed)
+    sigs2 = minhash.signatures([corpus.read_ids(dir2, f) for f in files2],
+                               bands * rows, seed)
+    metrics = []
+    for i, j in minhash.lsh_candidates(sigs1, sigs2, bands, rows):
+        sim = round(jaccard_ids(corpus.read_ids(dir1, files1[i]),
+                                corpus.read_ids(dir2, files2[j])) * 100)
+        if sim >= threshold:
+            metrics.append((files1[i], files2[j], sim))
+    return metrics
+
+
+def lsh_recall(dirname, threshold, bands=32, rows=4, corpus=None):
+    '''
+        Compare the LSH version against the exact threshold join for
+        jaccard, on each assignment. Print and return the overall recall.
+        Pairs for the same student (e.g. a file and itself) are left out,
+        as in threshold_pairs, since LSH always finds those.
+    '''
+    import minhash
+
+    def _other_students(sims):
+        return [(fn1, fn2) for (fn1, fn2, _) in sims
+                if fn1.split(defs.FILENAME_SEP, 1)[0] !=
+                fn2.split(defs.FILENAME_SEP, 1)[0]]
+    if corpus is None:
+        corpus = Corpus()
+    files = list_files(dirname, corpus)
+    files = [f for f in files if f.endswith(defs.VERILOG_SUFFIX)]
+    exact, approx = [], []
+    for block in group_by_assignment(files).values():
+        exact.extend(_other_students(compare_join(dirname, block, dirname,
+                                                  block, jaccard, corpus,
+                                                  threshold)))
+        approx.extend(_other_students(compare_lsh(dirname, block, dirname,
+                                                  block, corpus, threshold,
+                                                  bands, rows)))
+    recall = minhash.recall(approx, exact)
+    print('LSH bands={} rows={} (threshold ~{:.2f}): '
+          'found {} of {} pairs with sim >= {}, recall = {:.3f}'
+          .format(bands, rows, minhash.threshold_for(bands, rows),
+                  len(approx), len(exact), threshold, recall))
+    return recall
+
+
+def compare_pairs(dir1, files1, dir2, files2, cmpfunc, corpus, rows=None,
+                  progress=None):
+    '''
+        Compare every file in files1 against every file in files2,
+        one pair at a time (so this works for any metric).
+        If rows is given, only do those (indices of) files in files1.
+        If given progress (an instrument.Progress), step it once per row.
+        Empty files are skipped, as in compare_all.
+        Return an (unsorted) list of triples: (file1, file2, similarity)
+    '''
+    # Same files on both sides, so can use the upper triangle if symmetric:
+    symmetric = (is_symmetric(cmpfunc) and dir1 == dir2
+                 and list(files1) == list(files2))
+    if cmpfunc in INDEXED_METRICS:
+        cmpfunc = INDEXED_METRICS[cmpfunc]
+        read = corpus.read_ids
+    else:
+        read = corpus.read_file
+    if rows is None:
+        rows = range(len(files1))
+    metrics = []
+    if progress is not None:
+        rows = progress.counted(rows)
+    for i in rows:
+        fn1 = files1[i]
+        lines1 = read(dir1, fn1)
+        if len(lines1) == 0:
+            continue
+        for fn2 in (files2[i:] if symmetric else files2):
+            lines2 = read(dir2, fn2)
+            if len(lines2) == 0:
+                continue
+            sim = round(cmpfunc(lines1, lines2) * 100)
+            metrics.append((fn1, fn2, sim))
+            if symmetric and fn1 != fn2:
+                metrics.append((fn2, fn1, sim))
+    return metrics
+
+
+def compare_sequence(dir1, files1, dir2, files2, corpus, rows=None,
+                     threshold=0, progress=None):
+    '''
+        Same as compare_pairs for sm_compare, but go one file2 at a time,
+        so each SequenceMatcher indexes its b-side (set_seq2) only once.
+        If a threshold is given, use the cheap upper bounds on the ratio
+        to skip (and not return) pairs that could not reach it.
+        If given progress (an instrument.Progress), step it once per file2.
+        Return an (unsorted) list of triples: (file1, file2, similarity)
+    '''
+    if rows is None:
+        rows = range(len(files1))
+    left = [(files1[i], corpus.read_file(dir1, files1[i])) for i in rows]
+    left = [(fn1, lines1) for (fn1, lines1) in left if lines1]
+    metrics = []
+    if progress is not None:
+        files2 = progress.counted(files2)
+    for fn2 in files2:
+        lines2 = corpus.read_file(dir2, fn2)
+        if len(lines2) == 0:
+            continue
+        sm = SequenceMatcher(_line_is_junk)
+        sm.set_seq2(lines2)
+        for fn1, lines1 in left:
+            sm.set_seq1(lines1)
+            if threshold > 0:
+                if round(sm.real_quick_ratio() * 100) < threshold:
+                    continue
+                if round(sm.quick_ratio() * 100) < threshold:
+                    continue
+            sim = round(sm.ratio() * 100)
+            if sim >= threshold:
+                metrics.append((fn1, fn2, sim))
+    return metrics
+
+
+@instrument.timed('compare_block')
+def compare_block(dir1, files1, dir2, files2, cmpfunc, corpus, vectorise,
+                  rows=None, threshold=0, progress=None):
+    '''
+        Compare files1 against files2, using the faster version if we can.
+        If a threshold is given, only return sims at or above it.
+        If given progress (an instrument.Progress), step it once per file
+        (per file2 for the sequence metric, per row of files1 otherwise;
+        the matrix and join versions do all theirs at the end).
+        Return an (unsorted) list of triples: (file1, file2, similarity)
+    '''
+    if vectorise and cmpfunc is sm_compare:
+        return compare_sequence(dir1, files1, dir2, files2, corpus, rows,
+                                threshold, progress)
+    if vectorise and threshold > 0 and cmpfunc in JOIN_METRICS:
+        metrics = compare_join(dir1, files1, dir2, files2, cmpfunc, corpus,
+                               threshold, rows)
+    elif vectorise and cmpfunc in MATRIX_METRICS:
+        metrics = compare_matrix(dir1, files1, dir2, files2, cmpfunc, corpus,
+                                 rows)
+    else:
+        metrics = compare_pairs(dir1, files1, dir2, files2, cmpfunc, corpus,
+                                rows, progress)
+        progress = None  # Already stepped
+    if progress is not None:
+        progress.step(len(files1) if rows is None else len(rows))
+    if threshold > 0:
+        metrics = [t for t in metrics if t[2] >= threshold]
+    return metrics
+
+
+# #####################################################################
+# Parallel version: shard the rows over a pool of processes
+# #####################################################################
+
+# Each worker process gets its own copy of the corpus (once, at start-up):
+_worker_corpus = None
+
+
+def _init_worker(corpus):
+    '''Runs once in each worker process, to store the shared corpus'''
+    global _worker_corpus
+    _worker_corpus = corpus
+
+
+def _compare_shard(dir1, files1, dir2, files2, cmpfunc, vectorise, rows):
+    '''Runs in a worker process: compare one shard of rows'''
+    return compare_block(dir1, files1, dir2, files2, cmpfunc,
+                         _worker_corpus, vectorise, rows)
+
+
+def start_pool(corpus, workers, dirnames):
+    '''
+        Read every .v file in dirnames into the corpus, and then
+        start a pool of worker processes, each with a copy of the corpus.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    for dirname in dirnames:
+        files = list_files(dirname, corpus)
+        for filename in files:
+            if filename.endswith(defs.VERILOG_SUFFIX):
+                corpus.read_file(dirname, filename)
+    return ProcessPoolExecutor(max_workers=workers,
+                               initializer=_init_worker, initargs=(corpus,))
+
+
+def compare_sharded(dir1, files1, dir2, files2, cmpfunc, pool, nshards,
+                    vectorise=True, progress=None):
+    '''
+        Compare files1 against files2, splitting the rows (files1)
+        into nshards shards, which are run in parallel by the pool.
+        Rows are dealt out in turn, to balance the upper triangles.
+        If given progress (an instrument.Progress), step it by the
+        number of rows in each shard, as that shard finishes.
+        Return an (unsorted) list of triples: (file1, file2, similarity)
+        in the same order every time.
+    '''
+    nshards = max(1, min(nshards, len(files1)))
+    shards = {pool.submit(_compare_shard, dir1, files1, dir2, files2,
+                          cmpfunc, vectorise, rows): len(rows)
+              for rows in [range(k, len(files1), nshards)
+                           for k in range(nshards)]}
+    futures = list(shards)
+    if progress is not None:
+        from concurrent.futures import as_completed
+        for future in as_completed(futures):
+            progress.step(shards[future])
+    metrics = []
+    for future in futures:  # Collect in order, so output is deterministic
+        metrics.extend(future.result())
+    return metrics
+
+
+def compare_all_parallel(dirname, myfilter, cmpfunc, pool, nshards,
+                         vectorise=True, blocked=False, corpus=None):
+    '''
+        Same as compare_all (or compare_all_blocked), but run in parallel.
+        The pool should come from start_pool, so it has the corpus
+        (which is only used here to list the files).
+    '''
+    files = list_files(dirname, corpus)
+    files = [f for f in files if myfilter(f)]
+    blocks = group_by_assignment(files).values() if blocked else [files]
+    progress = instrument.Progress(len(files), 'files')
+    metrics = []
+    for block in blocks:
+        metrics.extend(compare_sharded(dirname, block, dirname, block,
+                                       cmpfunc, pool, nshards, vectorise,
+                                       progress))
+    return sorted(metrics, key=lambda t: t[0]+t[1])
+
+
+def compare_cached(dir1, files1, dir2, files2, cmpfunc, corpus, cache,
+                   vectorise=True, pool=None, nshards=1):
+    '''
+        Compare files1 against files2, using the scores in the cache.
+        Files with the same contents are only compared once (using the
+        first one as representative), and only if the cache doesn't
+        have that score already. New scores are added to the cache.
+        If given a pool (from start_pool), the rows that are missing
+        are scored in parallel, as nshards shards (see compare_sharded).
+        Return an (unsorted) list of triples: (file1, file2, similarity)
+    '''
+    import paircache
+    metric = [m.name for m in METRICS.values() if m.cmpfunc is cmpfunc][0]
+
+    def _hashes(dirname, files):
+        hashes = {}
+        for f in files:
+            lines = corpus.read_file(dirname, f)
+            if lines:  # Empty files are skipped, as in compare_all
+                hashes[f] = paircache.content_hash(lines)
+        reps = {}  # Map each hash to its first file
+        for f, h in hashes.items():
+            reps.setdefault(h, f)
+        return (hashes, reps)
+    hashes1, reps1 = _hashes(dir1, files1)
+    hashes2, reps2 = _hashes(dir2, files2)
+    wanted = [(h1, h2) for h1 in reps1 for h2 in reps2]
+    scores = cache.get_many(metric, wanted)
+    # Compare the representatives for any rows with scores missing:
+    missing = sorted({h1 for (h1, h2) in wanted if (h1, h2) not in scores})
+    if len(missing) > 0:
+        rows = [reps1[h1] for h1 in missing]
+        if pool is not None:
+            newsims = compare_sharded(dir1, rows, dir2, list(reps2.values()),
+                                      cmpfunc, pool, nshards, vectorise)
+        else:
+            newsims = compare_block(dir1, rows, dir2, list(reps2.values()),
+                                    cmpfunc, corpus, vectorise)
+        newscores = {(hashes1[fn1], hashes2[fn2]): sim
+                     for (fn1, fn2, sim) in newsims}
+        cache.put_many(metric, newscores)
+        scores.update(newscores)
+    # Now fan the scores back out to all the files:
+    return [(fn1, fn2, scores[(h1, h2)])
+            for fn1, h1 in hashes1.items() for fn2, h2 in hashes2.items()]
+
+
+def compare_all_cached(dirname, myfilter, cmpfunc, corpus, cache,
+                       vectorise=True, blocked=False, pool=None, nshards=1):
+    '''
+        Same as compare_all (or compare_all_blocked), using the cache,
+        and the pool (if given) for any scores it doesn't have.
+    '''
+    if corpus is None:
+        corpus = Corpus()
+    files = list_files(dirname, corpus)
+    files = [f for f in files if myfilter(f)]
+    blocks = group_by_assignment(files).values() if blocked else [files]
+    metrics = []
+    for block in blocks:
+        metrics.extend(compare_cached(dirname, block, dirname, block,
+                                      cmpfunc, corpus, cache, vectorise,
+                                      pool, nshards))
+    return sorted(metrics, key=lambda t: t[0]+t[1])
+
+
+def group_by_assignment(files):
+    '''
+        Group the files (named like XXX-Filename.v) by assignment.
+        Return a dict mapping assignment to list of files for it.
+    '''
+    blocks = {}
+    for filename in files:
+        _, assign = filename.split(defs.FILENAME_SEP, 1)
+        if assign not in blocks:
+            blocks[assign] = []
+        blocks[assign].append(filename)
+    return blocks
+
+
+def compare_all_blocked(dirname, myfilter, cmpfunc, corpus=None,
+                        vectorise=True):
+    '''
+        Same as compare_all, but only compare files for the same assignment,
+        since that is all the sim readers use (a1 == a2).
+        Cross-assignment totals are available from diff_totals.
+    '''
+    if corpus is None:
+        corpus = Corpus()
+    files = list_files(dirname, corpus)
+    files = [f for f in files if myfilter(f)]
+    progress = instrument.Progress(len(files), 'files')
+    metrics = []
+    for block in group_by_assignment(files).values():
+        metrics.extend(compare_block(dirname, block, dirname, block,
+                                     cmpfunc, corpus, vectorise,
+                                     progress=progress))
+    return sorted(metrics, key=lambda t: t[0]+t[1])
+
+
+def diff_totals(dirname, cmpfunc, corpus=None, vectorise=True):
+    '''
+        For the silhouette analysis: compare every assignment block with
+        every other, but only keep the total difference per block.
+        Return the same map as plot_graphs.read_diff_totals, i.e.
+            (assignment, student) -> list-of-diffs-per-assignment
+    '''
+    if corpus is None:
+        corpus = Corpus()
+    pnum = dict(zip(defs.assignments, range(len(defs.assignments))))
+    files = list_files(dirname, corpus)
+    files = [f for f in files if f.endswith(defs.VERILOG_SUFFIX)]
+    blocks = group_by_assignment(files)
+    totals = {a: {} for a in defs.assignments}
+    for a1, files1 in blocks.items():
+        for a2, files2 in blocks.items():
+            sims = compare_block(dirname, files1, dirname, files2,
+                                 cmpfunc, corpus, vectorise)
+            for fn1, fn2, sim in sims:
+                s1 = fn1.split(defs.FILENAME_SEP, 1)[0]
+                s2 = fn2.split(defs.FILENAME_SEP, 1)[0]
+                if s1 == s2:  # always ignore self-self comparison
+                    continue
+                if s1 not in totals[a1]:
+                    totals[a1][s1] = [0] * len(defs.assignments)
+                totals[a1][s1][pnum[a2]] += 100 - sim
+    return totals
+
+
+def threshold_pairs(dirname, cmpfunc, threshold, corpus=None,
+                    special_dir=None, lsh=None):
+    '''
+        Find the pairs of students with sim >= threshold for each assignment,
+        straight from the source files (so no need for a .dat file).
+        If given a special_dir, also add (special-kind, student) pairs.
+        If given lsh=(bands, rows), use the approximate version (jaccard).
+        Return a dict mapping each assignment to a list of pairs.
+    '''
+    def _compare(dir1, files1, dir2, files2):
+        if lsh is not None:
+            assert cmpfunc is jaccard, 'LSH only approximates jaccard'
+            return compare_lsh(dir1, files1, dir2, files2, corpus,
+                               threshold, *lsh)
+        return compare_block(dir1, files1, dir2, files2, cmpfunc, corpus,
+                             True, threshold=threshold)
+
+    if corpus is None:
+        corpus = Corpus()
+    files = list_files(dirname, corpus)
+    files = [f for f in files if f.endswith(defs.VERILOG_SUFFIX)]
+    blocks = group_by_assignment(files)
+    specials = {}
+    if special_dir is not None:
+        sfiles = list_files(special_dir, corpus)
+        specials = group_by_assignment(
+            [f for f in sfiles if f.endswith(defs.VERILOG_SUFFIX)])
+    pairs = {a: [] for a in defs.assignments}
+    for assign, block in blocks.items():
+        sims = _compare(dirname, block, dirname, block)
+        sims = sorted(sims, key=lambda t: t[0]+t[1])
+        if assign in specials:  # These go after the student pairs
+            ssims = _compare(special_dir, specials[assign], dirname, block)
+            sims.extend(sorted(ssims, key=lambda t: t[0]+t[1]))
+        for fn1, fn2, _ in sims:
+            s1 = fn1.split(defs.FILENAME_SEP, 1)[0]
+            s2 = fn2.split(defs.FILENAME_SEP, 1)[0]
+            if s1 != s2:
+                pairs[assign].append((s1, s2))
+    return pairs
+
+
+def compare_all_store(dirname, myfilter, cmpfunc, corpus=None,
+                      blocked=False):
+    '''
+        Same as compare_all_fast (or compare_all_blocked), for the set
+        metrics (those in MATRIX_METRICS), but return a simstore.SimStore,
+        made straight from the matrix of sims for each block,
+        without a triple for each pair.
+    '''
+    import simstore
+    if corpus is None:
+        corpus = Corpus()
+    files = list_files(dirname, corpus)
+    files = [f for f in files if myfilter(f)]
+    blocks = group_by_assignment(files).values() if blocked else [files]
+    progress = instrument.Progress(len(files), 'files')
+    parts = []
+    for block in blocks:
+        parts.append(score_matrix(dirname, block, dirname, block, cmpfunc,
+                                  corpus))
+        progress.step(len(block))
+    return simstore.matrix_store(parts, full=not blocked)
+
+
+def compare_all_fast(dirname, myfilter, cmpfunc, corpus=None):
+    '''
+        Same as compare_all, but use the faster version of the metric:
+        the set metrics do the full NxN as a few batched matrix operations,
+        and the sequence metric only indexes each file once.
+    '''
+    if corpus is None:
+        corpus = Corpus()
+    files = list_files(dirname, corpus)
+    files = [f for f in files if myfilter(f)]
+    progress = instrument.Progress(len(files), 'files')
+    metrics = compare_block(dirname, files, dirname, files, cmpfunc, corpus,
+                            vectorise=True, progress=progress)
+    return sorted(metrics, key=lambda t: t[0]+t[1])
+
+
+def do_one_compare(outfile, datadir, cmpfunc, corpus=None, vectorise=True,
+                   blocked=False, pool=None, nshards=1, binary=False,
+                   cache=None):
     '''
         Compare all programs in datadir, write results to output file.
+        If vectorise, use the faster versions of the metrics.
+        If blocked, only write comparisons within the same assignment.
+        If given a pool (from start_pool), run nshards shards in parallel.
+        If binary, write a .sim file (see simstore) instead of a .dat file
+        (for the set metrics, straight from the matrix of sims).
+        If given a cache (a paircache.PairCache), use and update it.
     '''
     def _file_filter(filename):
         return filename.endswith(defs.VERILOG_SUFFIX)
+    check_fraction(cmpfunc)
     print(outfile, end=': ', flush=True)
-    metrics = compare_all(datadir, _file_filter, cmpfunc)
+    with instrument.Job(outfile) as job:
+        if (binary and vectorise and cache is None and pool is None
+                and cmpfunc in MATRIX_METRICS):
+            metrics = compare_all_store(datadir, _file_filter, cmpfunc,
+                                        corpus, blocked)
+        elif cache is not None:
+            metrics = compare_all_cached(datadir, _file_filter, cmpfunc,
+                                         corpus, cache, vectorise, blocked,
+                                         pool, nshards)
+        elif pool is not None:
+            metrics = compare_all_parallel(datadir, _file_filter, cmpfunc,
+                                           pool, nshards, vectorise, blocked,
+                                           corpus)
+        elif blocked:
+            metrics = compare_all_blocked(datadir, _file_filter, cmpfunc,
+                                          corpus, vectorise)
+        elif vectorise:
+            metrics = compare_all_fast(datadir, _file_filter, cmpfunc, corpus)
+        else:
+            metrics = compare_all(datadir, _file_filter, cmpfunc, corpus)
+        job.add(len(metrics))
+        instrument.count('pairs scored', len(metrics))
+    with instrument.timer('write_results'):
+        outpath = write_results(outfile, datadir, metrics, blocked, binary)
+    print('\n\t- written to ', outpath)
+
+
+def write_results(outfile, datadir, metrics, blocked=False, binary=False):
+    '''
+        Write the (sorted) triples for datadir to the output file,
+        as text (.dat) or, if binary, as a .sim file (see simstore).
+        If binary, the metrics can also be a SimStore already
+        (e.g. from compare_all_store).
+        Return the path of the file written.
+    '''
+    if binary:
+        import simstore
+        outpath = os.path.join(datadir, '..', outfile+defs.SIM_SUFFIX)
+        if not isinstance(metrics, simstore.SimStore):
+            metrics = simstore.make_store(metrics, full=not blocked)
+        simstore.save_store(outpath, metrics)
+        return outpath
     outpath = os.path.join(datadir, '..', outfile+defs.DATA_SUFFIX)
     with open(outpath, 'w') as fh:
         for s1, s2, m in metrics:
             fh.write('{} {} {}\n'.format(s1, s2, m))
-    print('\n\t- written to ', outpath)
+    return outpath
 
 
-def do_all_compare():
-    metrics = {
-        'jaccard': jaccard, 'tversky': tv_asymmetric, 'sequence': sm_compare
-    }
-    for (metric, cmpfunc) in metrics.items():
+def do_all_compare(corpus=None, vectorise=True, blocked=False, workers=1,
+                   binary=False, cache=None):
+    '''
+        Run every metric over every process, sharing one corpus,
+        so each file is only read once for the whole run.
+        If workers > 1, run each one in parallel on that many processes.
+        If binary, write .sim files instead of .dat files.
+        If given a cache (a paircache.PairCache), only compare pairs
+        of file contents that aren't already in it; close the cache
+        after the run, so its old scores are evicted then.
+    '''
+    if corpus is None:
+        corpus = Corpus()
+    pool = None
+    if workers > 1:
+        src_dirs = [defs.latest_dir(proc) for proc in defs.ALL_PROCESS]
+        pool = start_pool(corpus, workers, src_dirs)
+    for metric in defs.ALL_METRICS:
+        cmpfunc = METRICS[metric].cmpfunc
         for proc in defs.ALL_PROCESS:
                 src_dir = defs.latest_dir(proc)
                 basename = metric + defs.FILENAME_SEP + proc
-                do_one_compare(basename, src_dir, cmpfunc)
+                do_one_compare(basename, src_dir, cmpfunc, corpus, vectorise,
+                               blocked, pool, 4 * workers, binary, cache)
+    if pool is not None:
+        pool.shutdown()
 
 
 function = 2
@@ -50,13 +50,23 @@ ALL_PROCESS = ['orig', 'clean', 'token']
 
 # File suffix for any data I write:
 DATA_SUFFIX = '.dat'
+# File suffix for the binary version (see simstore):
+SIM_SUFFIX = '.sim'
+# File suffix for the list of file hashes behind a data file:
+MANIFEST_SUFFIX = '.manifest'
 DOT_SUFFIX = '.dot'
 
 
 RESULTS_DIR = os.path.join(_THIS_DIR, '..', 'results')
 
+# Where scores are cached between runs (see paircache):
+PAIRCACHE_FILE = os.path.join(RESULTS_DIR, 'paircache.db')
+
 GRAPHS_DIR = os.path.join(RESULTS_DIR, 'graphs')
 GRAPHS_SUFFIX = '.pdf'
+# The (optional) quick previews of the graphs:
+PREVIEW_SUFFIX = '.png'
+PREVIEW_DPI = 72
 GRAPH_LABEL_SIZE = 16
 
 
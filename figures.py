@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+'''
+    Lazy access to matplotlib and graphviz, so that modules which only
+    compute (compare, specials, cliques, ...) never have to import them.
+    The text set-up is done once, the first time pyplot() is called:
+        usetex: all text is set by LaTeX, so we only get Type 1 fonts
+                (as needed for the paper), but TeX must be installed
+                and every figure is slower;
+        otherwise: matplotlib's own mathtext, with the Computer Modern
+                fonts, and TrueType fonts embedded in PDFs.
+    By default, usetex is used if LaTeX can be found; to choose, set
+    SIM_USETEX=1 or SIM_USETEX=0, or call use_tex before plotting.
+'''
+
+import os
+import shutil
+
+import defs
+
+# None means 'use TeX if it is installed':
+_usetex = {'1': True, '0': False}.get(os.environ.get('SIM_USETEX'))
+
+# The pyplot module, once imported and set up:
+_plt = None
+
+
+def use_tex(usetex):
+    '''Choose whether to use LaTeX for the text (before any plotting)'''
+    global _usetex
+    assert _plt is None, 'too late: pyplot is already set up'
+    _usetex = usetex
+
+
+def usetex():
+    '''Are we using LaTeX for the text?'''
+    global _usetex
+    if _usetex is None:
+        _usetex = shutil.which('latex') is not None
+    return _usetex
+
+
+def pyplot():
+    '''Import and set up matplotlib.pyplot (the first time), return it'''
+    global _plt
+    if _plt is None:
+        import matplotlib.pyplot as plt
+        if usetex():
+            # Make sure we only use Type 1 fonts:
+            plt.rc('text', usetex=True)
+            plt.rc('font', family='serif')
+        else:
+            plt.rc('mathtext', fontset='cm')
+            plt.rc('font', family='serif', serif=['DejaVu Serif'])
+            plt.rc('pdf', fonttype=42)
+        plt.rc('axes', labelsize=defs.GRAPH_LABEL_SIZE)
+        _plt = plt
+    return _plt
+
+
+def bold(text):
+    '''Mark up the text to be printed in bold'''
+    if usetex():
+        return '\\textbf{' + text + '}'
+    return '$\\mathbf{' + text.replace('_', '\\_') + '}$'
+
+
+def escape(text):
+    '''Protect any characters in the text that LaTeX would change'''
+    if usetex():
+        return text.replace('_', '\\_')
+    return text
+
+
+def save(fig, basename, preview=False, pdf=True, **kwargs):
+    '''
+        Save the figure in GRAPHS_DIR, as basename (plus GRAPHS_SUFFIX).
+        If preview, also save a (quick to make and view) PNG version;
+        if not pdf, only save the PNG. Other arguments go to savefig.
+    '''
+    if pdf:
+        fig.savefig(os.path.join(defs.GRAPHS_DIR,
+                                 basename + defs.GRAPHS_SUFFIX), **kwargs)
+    if preview or not pdf:
+        fig.savefig(os.path.join(defs.GRAPHS_DIR,
+                                 basename + defs.PREVIEW_SUFFIX),
+                    dpi=defs.PREVIEW_DPI, **kwargs)
+
+
+def graph(**kwargs):
+    '''Return a new graphviz Graph, made with these arguments'''
+    from graphviz import Graph
+    return Graph(**kwargs)
@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+'''
+    Keep the similarity results up to date as new submissions arrive.
+    Beside each results file (metric-proc) we keep a manifest, giving
+    the content hash of every file in the latest directory it came from.
+    Next time, only the rows and columns for the files that have been
+    added, changed or removed since then are recomputed, and patched
+    into the stored results (see simstore.patch_store and patch_dat),
+    so the rest of them are never read in as triples or sorted again.
+'''
+
+import os
+import json
+import hashlib
+
+import defs
+import compare
+import simstore
+
+
+def file_hashes(dirname):
+    '''Return a dict mapping each .v file in dirname to its content hash'''
+    hashes = {}
+    with os.scandir(dirname) as entries:
+        for entry in entries:
+            if entry.name.endswith(defs.VERILOG_SUFFIX) and entry.is_file():
+                with open(entry.path, 'rb') as fh:
+                    hashes[entry.name] = hashlib.sha1(fh.read()).hexdigest()
+    return hashes
+
+
+def _manifest_path(basename):
+    return os.path.join(defs.RESULTS_DIR, basename+defs.MANIFEST_SUFFIX)
+
+
+def read_manifest(basename):
+    '''Return the manifest for these results (or None if there isn't one)'''
+    path = _manifest_path(basename)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as fh:
+        return json.load(fh)
+
+
+def write_manifest(basename, hashes, outpath, blocked, binary):
+    '''Record the file hashes behind the results just written to outpath'''
+    manifest = {'hashes': hashes, 'blocked': blocked, 'binary': binary,
+                'mtime': os.path.getmtime(outpath)}
+    with open(_manifest_path(basename), 'w') as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+
+
+def diff_hashes(old, new):
+    '''Return lists of the files (added, changed, removed) from old to new'''
+    added = sorted(f for f in new if f not in old)
+    changed = sorted(f for f in new if f in old and old[f] != new[f])
+    removed = sorted(f for f in old if f not in new)
+    return (added, changed, removed)
+
+
+def _recompare(datadir, fresh, files, cmpfunc, corpus):
+    '''
+        Compare the fresh files against all the files, both ways round.
+        For a symmetric metric, the other way round is just a mirror.
+    '''
+    metrics = compare.compare_block(datadir, fresh, datadir, files,
+                                    cmpfunc, corpus, True)
+    others = [f for f in files if f not in fresh]
+    if compare.is_symmetric(cmpfunc):
+        metrics.extend((fn2, fn1, sim) for (fn1, fn2, sim) in metrics
+                       if fn2 not in fresh)
+    else:
+        metrics.extend(compare.compare_block(datadir, others, datadir, fresh,
+                                             cmpfunc, corpus, True))
+    return metrics
+
+
+def update_one(metric, proc, corpus=None, blocked=False, binary=False):
+    '''
+        Bring the results for one metric-proc up to date.
+        If there's no usable manifest, do the full comparison.
+        Return the number of files that had to be compared.
+    '''
+    if corpus is None:
+        corpus = compare.Corpus()
+    basename = metric + defs.FILENAME_SEP + proc
+    datadir = defs.latest_dir(proc)
+    cmpfunc = compare.METRICS[metric].cmpfunc
+    hashes = file_hashes(datadir)
+    suffix = defs.SIM_SUFFIX if binary else defs.DATA_SUFFIX
+    outpath = os.path.join(datadir, '..', basename+suffix)
+    manifest = read_manifest(basename)
+    if (manifest is None or not os.path.isfile(outpath)
+            or manifest['mtime'] != os.path.getmtime(outpath)
+            or manifest['blocked'] != blocked
+            or manifest['binary'] != binary):
+        compare.do_one_compare(basename, datadir, cmpfunc, corpus,
+                               blocked=blocked, binary=binary)
+        write_manifest(basename, hashes, outpath, blocked, binary)
+        return len(hashes)
+    added, changed, removed = diff_hashes(manifest['hashes'], hashes)
+    if len(added) + len(changed) + len(removed) == 0:
+        return 0
+    # Work out the new rows and columns:
+    stale = set(added) | set(changed) | set(removed)
+    fresh = sorted(added + changed)
+    files = sorted(hashes)
+    metrics = []
+    if blocked:
+        for block in compare.group_by_assignment(files).values():
+            some = [f for f in fresh if f in block]
+            if len(some) > 0:
+                metrics.extend(_recompare(datadir, some, block,
+                                          cmpfunc, corpus))
+    else:
+        metrics.extend(_recompare(datadir, fresh, files, cmpfunc, corpus))
+    # Then put them in place of the old results for the stale files:
+    if binary:
+        simstore.patch_store(outpath, stale, metrics)
+    else:
+        simstore.patch_dat(outpath, stale, metrics)
+    write_manifest(basename, hashes, outpath, blocked, binary)
+    print('{}: {} added, {} changed, {} removed'.format(
+            basename, len(added), len(changed), len(removed)))
+    return len(fresh)
+
+
+def update_all(blocked=False, binary=False):
+    '''
+        Bring the results for every metric and process up to date,
+        sharing one corpus, so each file is only read once.
+    '''
+    corpus = compare.Corpus()
+    for metric in defs.ALL_METRICS:
+        for proc in defs.ALL_PROCESS:
+            update_one(metric, proc, corpus, blocked, binary)
+
+
+function = 1
+if __name__ == '__main__':
+    if function == 1:
+        update_all()
@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+'''
+    Lightweight instrumentation: named timers and counters (kept in
+    module-level dicts), progress with throughput and ETA for each job,
+    and optional cProfile/tracemalloc hooks.
+    It is all switched on from the environment, so a run can be
+    instrumented without editing the scripts:
+        SIM_INSTRUMENT=1        collect timers and counters,
+                                and print a report at exit
+        SIM_PROFILE=file.prof   also run cProfile, save the stats in file
+        SIM_TRACEMALLOC=1       also trace memory, report the peak
+    When switched off, the timers and counters do (almost) nothing.
+    Worker processes (see compare.start_pool) keep their own counts,
+    which are not reported.
+    cProfile and tracemalloc are only imported when they are used.
+'''
+
+import os
+import sys
+import time
+import atexit
+import functools
+
+from collections import Counter
+from contextlib import contextmanager
+
+enabled = False
+
+# Total seconds and number of calls for each timer, and the counters:
+timers = Counter()
+calls = Counter()
+counters = Counter()
+
+# For each job: (pairs, seconds), summed if run more than once
+jobs = {}
+
+_profiler = None
+_profile_path = None
+
+
+def count(name, n=1):
+    '''Add n to the named counter'''
+    if enabled:
+        counters[name] += n
+
+
+@contextmanager
+def timer(name):
+    '''Time the code in the with block, adding it to the named timer'''
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timers[name] += time.perf_counter() - start
+        calls[name] += 1
+
+
+def timed(name):
+    '''A decorator: time every call to the function'''
+    def _decorate(func):
+        @functools.wraps(func)
+        def _timed(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with timer(name):
+                return func(*args, **kwargs)
+        return _timed
+    return _decorate
+
+
+class Progress:
+    '''
+        Print the progress through total steps, at every 10%.
+        If instrumenting, also print the rate so far and the ETA.
+        Either say how many steps are done so far (update), or
+        how many more have just been done (step), or go through
+        the steps in a for loop (counted).
+    '''
+    def __init__(self, total, unit='pairs'):
+        self.total = total
+        self.unit = unit
+        self.done = 0
+        self.start = time.perf_counter()
+        self.marks = list(range(0, 101, 10))
+
+    def update(self, done):
+        '''We've done this many steps (so far)'''
+        self.done = done
+        if len(self.marks) == 0 or self.total == 0:
+            return
+        reached = int(done*100/self.total)
+        if reached < self.marks[0]:
+            return
+        while len(self.marks) > 0 and reached >= self.marks[0]:
+            percent = self.marks[0]
+            self.marks = self.marks[1:]
+        if enabled and done > 0:
+            seconds = time.perf_counter() - self.start
+            rate = done / seconds if seconds > 0 else 0
+            eta = (self.total - done) / rate if rate > 0 else 0
+            print('{}% ({:.0f} {}/s, ETA {:.0f}s)'.format(
+                percent, rate, self.unit, eta), flush=True, end=' ')
+        else:
+            print('{}%'.format(percent), flush=True, end=' ')
+
+    def step(self, n=1):
+        '''We've done n more steps'''
+        self.update(self.done + n)
+
+    def counted(self, items):
+        '''Yield each of the items, taking a step after each one is done'''
+        for item in items:
+            yield item
+            self.step()
+
+
+class Job:
+    '''
+        A with block for one job (e.g. a metric x process comparison).
+        Call add(n) when n pairs have been scored; at the end,
+        the job's time and throughput are recorded (and printed).
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.pairs = 0
+
+    def add(self, npairs):
+        self.pairs += npairs
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if enabled:
+            seconds = time.perf_counter() - self.start
+            pairs, total = jobs.get(self.name, (0, 0.0))
+            jobs[self.name] = (pairs + self.pairs, total + seconds)
+            timers['job ' + self.name] += seconds
+            calls['job ' + self.name] += 1
+            print('\n\t- {} pairs in {:.2f}s ({:.0f} pairs/s)'.format(
+                self.pairs, seconds, self.pairs / seconds if seconds else 0),
+                end='')
+        return False
+
+
+def report(outfh=sys.stderr):
+    '''Print the timers, counters and jobs'''
+    print('=== Timers (seconds, calls):', file=outfh)
+    for name, seconds in timers.most_common():
+        print('\t{:40s} {:10.3f} {:8d}'.format(name, seconds, calls[name]),
+              file=outfh)
+    print('=== Counters:', file=outfh)
+    for name, value in sorted(counters.items()):
+        print('\t{:40s} {:10d}'.format(name, value), file=outfh)
+    if len(jobs) > 0:
+        print('=== Jobs (pairs, seconds, pairs/s):', file=outfh)
+        for name, (pairs, seconds) in jobs.items():
+            print('\t{:40s} {:10d} {:10.3f} {:10.0f}'.format(
+                name, pairs, seconds, pairs / seconds if seconds else 0),
+                file=outfh)
+    import tracemalloc
+    if tracemalloc.is_tracing():
+        _, peak = tracemalloc.get_traced_memory()
+        print('=== Peak traced memory: {:.1f} MB'.format(peak / 2**20),
+              file=outfh)
+
+
+def start(profile_path=None, trace_memory=False):
+    '''Switch on the timers and counters, and maybe the profilers'''
+    global enabled, _profiler, _profile_path
+    enabled = True
+    if trace_memory:
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+    if profile_path is not None and _profiler is None:
+        import cProfile
+        _profile_path = profile_path
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+
+def stop(outfh=sys.stderr):
+    '''Print the report, save any profile, and switch everything off'''
+    global enabled, _profiler
+    if not enabled:
+        return
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(_profile_path)
+        print('Profile written to {}.'.format(_profile_path), file=outfh)
+        _profiler = None
+    report(outfh)
+    import tracemalloc
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    enabled = False
+
+
+if os.environ.get('SIM_INSTRUMENT') or os.environ.get('SIM_PROFILE'):
+    start(os.environ.get('SIM_PROFILE'),
+          bool(os.environ.get('SIM_TRACEMALLOC')))
+    atexit.register(stop)
@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+'''
+    Approximate Jaccard similarity for large cohorts, using MinHash.
+    Each file (a set of line IDs) gets a signature of num_perm min-hashes;
+    the signatures are cut into bands of rows, and files that agree on
+    every row of any band land in the same bucket, and so are candidates.
+    A pair with Jaccard similarity s becomes a candidate with probability
+        1 - (1 - s^rows)^bands
+    so the (b, r) values set the threshold: roughly (1/bands)^(1/rows).
+    Candidates should then be checked with the exact metric.
+'''
+
+import numpy as np
+
+# Hash functions are h(x) = (a*x + b) mod p, with p prime,
+# so that a*x + b fits in 64 bits:
+_PRIME = (1 << 31) - 1
+
+
+def hash_params(num_perm, seed=1):
+    '''Return the (a, b) arrays for num_perm random hash functions'''
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, _PRIME, size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, _PRIME, size=num_perm, dtype=np.uint64)
+    return (a, b)
+
+
+def _mix(ids):
+    '''
+        Scramble the IDs (splitmix64's finaliser) before the linear hashes,
+        so they are spread evenly over all 64 bits whatever IDs are given;
+        the line IDs (see compare.line_id) are already 63-bit hashes,
+        but the IDs could be any integers.
+    '''
+    x = np.asarray(ids, dtype=np.uint64)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    x = x ^ (x >> np.uint64(31))
+    return x % np.uint64(_PRIME)
+
+
+def signatures(idlists, num_perm=128, seed=1, chunk=1000):
+    '''
+        Work out the MinHash signature of each (non-empty) list of IDs.
+        For each chunk of files, all the hashes are done at once, and then
+        np.minimum.reduceat takes the minimum over each file's slice.
+        Return an array, shape = #files, num_perm
+    '''
+    a, b = hash_params(num_perm, seed)
+    sigs = np.zeros((len(idlists), num_perm), dtype=np.uint64)
+    for first in range(0, len(idlists), chunk):
+        some = idlists[first:first+chunk]
+        sizes = np.array([len(ids) for ids in some], dtype=np.int64)
+        assert np.all(sizes > 0), 'cannot sign an empty file'
+        allids = _mix(np.concatenate([np.asarray(ids, dtype=np.uint64)
+                                      for ids in some]))
+        hashes = (a[:, np.newaxis] * allids[np.newaxis, :]
+                  + b[:, np.newaxis]) % _PRIME
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        sigs[first:first+len(some)] = np.minimum.reduceat(hashes, starts,
+                                                          axis=1).T
+    return sigs
+
+
+def estimate_jaccard(sig1, sig2):
+    '''Estimate the Jaccard similarity from two signatures'''
+    return float(np.mean(sig1 == sig2))
+
+
+def threshold_for(bands, rows):
+    '''The (approximate) Jaccard similarity where LSH starts to find pairs'''
+    return (1 / bands) ** (1 / rows)
+
+
+def lsh_candidates(sigs1, sigs2, bands, rows):
+    '''
+        Put each signature into a bucket for each band, and return the
+        pairs (i, j) where sigs1[i] and sigs2[j] share at least one bucket.
+    '''
+    assert bands * rows <= sigs1.shape[1], 'signatures too short'
+    pairs = set()
+    for band in range(bands):
+        cols = slice(band * rows, (band + 1) * rows)
+        buckets = {}
+        for j, sig in enumerate(sigs2[:, cols]):
+            buckets.setdefault(sig.tobytes(), []).append(j)
+        for i, sig in enumerate(sigs1[:, cols]):
+            for j in buckets.get(sig.tobytes(), []):
+                pairs.add((i, j))
+    return sorted(pairs)
+
+
+def recall(approx_pairs, exact_pairs):
+    '''What fraction of the exact pairs did the approximate method find?'''
+    exact_pairs = set(exact_pairs)
+    if len(exact_pairs) == 0:
+        return 1.0
+    return len(exact_pairs & set(approx_pairs)) / len(exact_pairs)
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+'''
+    A persistent cache of similarity scores, kept between runs.
+    Scores are indexed by (metric, content-hash-1, content-hash-2),
+    not by file name, so identical files (or a rerun with unchanged
+    files) never need to be compared again.
+    The cache holds at most maxsize scores: when a run is finished
+    (see PairCache.close), the scores from the oldest runs are thrown away.
+'''
+
+import hashlib
+import sqlite3
+import warnings
+
+import defs
+import instrument
+
+
+def content_hash(lines):
+    '''Return the hash (a 63-bit integer) for a file with these lines'''
+    digest = hashlib.blake2b(''.join(lines).encode('utf-8', 'surrogatepass'),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, 'little') >> 1
+
+
+class PairCache:
+    '''
+        The scores are stored in an sqlite database.
+        A run is from opening the cache to closing it. Each file content
+        (hash) has a 'used' value: the last run (a counter) that looked
+        up or added a score for it. The scores are evicted (at the end
+        of a run) in order of the older of their two hashes' runs.
+    '''
+    def __init__(self, path=defs.PAIRCACHE_FILE, maxsize=10000000):
+        self.maxsize = maxsize
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS sims ('
+                        ' metric TEXT, h1 INTEGER, h2 INTEGER, sim INTEGER,'
+                        ' PRIMARY KEY (metric, h1, h2))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS used ('
+                        ' h INTEGER PRIMARY KEY, run INTEGER)')
+        self.db.execute('CREATE TEMP TABLE wanted (h1 INTEGER, h2 INTEGER)')
+        (last, ) = self.db.execute('SELECT MAX(run) FROM used').fetchone()
+        self.run = 0 if last is None else last + 1
+        self.hits = 0
+        self.misses = 0
+
+    def _mark_used(self, hashes):
+        '''Record that these hashes have been used in this run'''
+        self.db.executemany('INSERT OR REPLACE INTO used VALUES (?, ?)',
+                            [(h, self.run) for h in hashes])
+
+    def get_many(self, metric, pairs):
+        '''
+            Look up the scores for a list of (hash1, hash2) pairs,
+            all at once (as a join with a temporary table of the pairs).
+            Return a dict mapping each pair that is in the cache to its score.
+        '''
+        self.db.execute('DELETE FROM wanted')
+        self.db.executemany('INSERT INTO wanted VALUES (?, ?)', pairs)
+        found = {(h1, h2): sim for (h1, h2, sim) in self.db.execute(
+                    'SELECT sims.h1, sims.h2, sims.sim FROM wanted'
+                    ' JOIN sims ON sims.metric=? AND sims.h1=wanted.h1'
+                    ' AND sims.h2=wanted.h2', (metric, ))}
+        self._mark_used({h for pair in pairs for h in pair})
+        self.hits += len(found)
+        self.misses += len(pairs) - len(found)
+        instrument.count('cache hits', len(found))
+        instrument.count('cache misses', len(pairs) - len(found))
+        return found
+
+    def put_many(self, metric, scores):
+        '''Add a dict mapping (hash1, hash2) pairs to scores'''
+        self.db.executemany(
+            'INSERT OR REPLACE INTO sims VALUES (?, ?, ?, ?)',
+            [(metric, h1, h2, sim) for ((h1, h2), sim) in scores.items()])
+        self._mark_used({h for pair in scores for h in pair})
+        self.db.commit()
+
+    def evict(self):
+        '''
+            Throw away the scores from the oldest runs, down to maxsize.
+            The scores used in this run are always kept, so if there are
+            more than maxsize of those, warn that the cache is too small.
+        '''
+        (size, ) = self.db.execute('SELECT COUNT(*) FROM sims').fetchone()
+        if size <= self.maxsize:
+            return
+        ages = ('FROM sims JOIN used AS u1 ON u1.h=sims.h1'
+                ' JOIN used AS u2 ON u2.h=sims.h2')
+        (current, ) = self.db.execute(
+            'SELECT COUNT(*) ' + ages + ' WHERE MIN(u1.run, u2.run)=?',
+            (self.run, )).fetchone()
+        if current > self.maxsize:
+            warnings.warn('this run used {} scores, but the cache only holds '
+                          '{}: make maxsize bigger'.format(current,
+                                                           self.maxsize))
+        self.db.execute('DELETE FROM sims WHERE rowid IN (SELECT sims.rowid '
+                        + ages + ' WHERE MIN(u1.run, u2.run)<?'
+                        ' ORDER BY MIN(u1.run, u2.run) LIMIT ?)',
+                        (self.run, size - max(self.maxsize, current)))
+        # Forget the hashes that no longer have any scores:
+        self.db.execute('DELETE FROM used WHERE run<? AND'
+                        ' h NOT IN (SELECT h1 FROM sims) AND'
+                        ' h NOT IN (SELECT h2 FROM sims)', (self.run, ))
+
+    def close(self):
+        '''End the run: evict any old scores, and save the cache'''
+        self.evict()
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,335 @@
+#!/usr/bin/python3
+'''
+    Run the whole pipeline from the command line, as a graph of jobs:
+        ingest -> latest-{orig,clean,token} and special-{...}
+               -> compare-metric-proc (metric-proc.dat)
+               -> special-metric-proc (special-metric-proc.dat)
+               -> cliques, violins, barchart, dot graphs
+    A job only runs if its inputs have changed since it last ran
+    (by mtime, or by content hash with --hash), or an output is missing.
+    For this, a stamp is kept for each job in RESULTS_DIR/pipeline.
+    Jobs that don't depend on each other can run in parallel (-j).
+    Examples:
+        python3 pipeline.py                 # bring everything up to date
+        python3 pipeline.py violins -j 4    # just the violin plots
+        python3 pipeline.py --list          # show the jobs and their state
+'''
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+
+from collections import OrderedDict
+from concurrent.futures import (ProcessPoolExecutor,
+                                wait, FIRST_COMPLETED)
+
+import defs
+import compare
+import specials
+import cliques
+import preprocess
+
+
+class Node:
+    '''
+        One job: run action(*args), which reads the inputs (files or
+        directories of files) and writes the outputs.
+        The deps are the names of the jobs that make the inputs.
+    '''
+    def __init__(self, name, inputs, outputs, deps, action, *args):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.deps = deps
+        self.action = action
+        self.args = args
+
+
+# The actions (at module level, so they can be run in other processes):
+
+def _ingest():
+    preprocess.load_all(write=True)
+
+
+def _compare(metric, proc):
+    basename = metric + defs.FILENAME_SEP + proc
+    compare.do_one_compare(basename, defs.latest_dir(proc),
+                           compare.METRICS[metric].cmpfunc)
+
+
+def _special(metric, proc):
+    specials.do_one_compare(defs.special_filename(metric, proc),
+                            defs.latest_dir(proc), defs.special_dir(proc),
+                            compare.METRICS[metric].cmpfunc)
+
+
+def _violins(versus_all):
+    import plot_graphs
+    plot_graphs.plot_assignment_sims(versus_all, save_to_file=True)
+
+
+def _special_violins(metric):
+    for special_kind in defs.ALL_SPECIALS:
+        specials.plot_special_sims(special_kind, metric, defs.ALL_PROCESS)
+
+
+def _barchart(metric, proc, threshold):
+    over, _ = cliques.get_cliques(metric, proc, threshold)
+    cliques.barchart_cliques(over, save_to_file=True)
+
+
+def _dot(metric, proc, threshold):
+    over, under = cliques.get_cliques(metric, proc, threshold)
+    cliques.dotgraph_cliques(over, under, defs.assignments)
+
+
+def _results(basename):
+    return os.path.join(defs.RESULTS_DIR, basename + defs.DATA_SUFFIX)
+
+
+def _graph(basename):
+    return os.path.join(defs.GRAPHS_DIR, basename + defs.GRAPHS_SUFFIX)
+
+
+def build_graph(threshold=100, metric='jaccard', proc='token'):
+    '''
+        Return all the jobs, in an order where each comes after its deps.
+        The cliques use the threshold; the barchart, dot graphs
+        and special violins are for the given metric (and proc).
+    '''
+    graph = OrderedDict()
+
+    def _add(node):
+        graph[node.name] = node
+    _add(Node('ingest',
+              [defs.DATAROOT] + [defs.special_src[k]
+                                 for k in defs.ALL_SPECIALS],
+              [defs.latest_dir(p) for p in defs.ALL_PROCESS] +
+              [defs.special_dir(p) for p in defs.ALL_PROCESS],
+              [], _ingest))
+    for m in defs.ALL_METRICS:
+        for p in defs.ALL_PROCESS:
+            basename = m + defs.FILENAME_SEP + p
+            _add(Node('compare-' + basename, [defs.latest_dir(p)],
+                      [_results(basename)], ['ingest'], _compare, m, p))
+            _add(Node('special-' + basename,
+                      [defs.latest_dir(p), defs.special_dir(p)],
+                      [defs.special_filename(m, p)], ['ingest'],
+                      _special, m, p))
+    for m in defs.ALL_METRICS:
+        names = [m + defs.FILENAME_SEP + p for p in defs.ALL_PROCESS]
+        _add(Node('cliques-' + m,
+                  [_results(n) for n in names] +
+                  [_results('special-' + n) for n in names],
+                  [_results(defs.FILENAME_SEP.join(['clique', m,
+                                                    str(threshold)]))],
+                  ['compare-' + n for n in names] +
+                  ['special-' + n for n in names],
+                  cliques.print_all_cliques, m, threshold))
+    allnames = [m + defs.FILENAME_SEP + p
+                for m in defs.ALL_METRICS for p in defs.ALL_PROCESS]
+    for versus in ['all', 'max']:
+        _add(Node('violins-' + versus, [_results(n) for n in allnames],
+                  [_graph('violin' + defs.FILENAME_SEP + versus)],
+                  ['compare-' + n for n in allnames],
+                  _violins, versus == 'all'))
+    names = [metric + defs.FILENAME_SEP + p for p in defs.ALL_PROCESS]
+    _add(Node('violins-special',
+              [_results('special-' + n) for n in names],
+              [_graph(defs.FILENAME_SEP.join(['violin', k, p]))
+               for k in defs.ALL_SPECIALS for p in defs.ALL_PROCESS],
+              ['special-' + n for n in names],
+              _special_violins, metric))
+    basename = metric + defs.FILENAME_SEP + proc
+    for kind, action, outputs in [
+            ('barchart', _barchart, [_graph('barchart')]),
+            ('dot', _dot, [os.path.join(defs.GRAPHS_DIR,
+                                        a.replace(defs.VERILOG_SUFFIX, '') +
+                                        defs.DOT_SUFFIX)
+                           for a in defs.assignments])]:
+        _add(Node(kind, [_results(basename), _results('special-' + basename)],
+                  outputs, ['compare-' + basename, 'special-' + basename],
+                  action, metric, proc, threshold))
+    return graph
+
+
+def _files(path):
+    '''List the files at path (the files in it, if it's a directory)'''
+    if os.path.isdir(path):
+        with os.scandir(path) as entries:
+            return sorted(e.path for e in entries if e.is_file())
+    return [path] if os.path.isfile(path) else []
+
+
+def signature(node, by_hash=False):
+    '''
+        Sum up the state of the job's inputs (and its arguments):
+        the name, size and mtime of each file, or its content hash.
+    '''
+    sig = hashlib.sha1(repr(node.args).encode('utf-8'))
+    for path in node.inputs:
+        for filepath in _files(path):
+            sig.update(filepath.encode('utf-8'))
+            if by_hash:
+                with open(filepath, 'rb') as fh:
+                    sig.update(hashlib.sha1(fh.read()).digest())
+            else:
+                st = os.stat(filepath)
+                sig.update('{} {}'.format(st.st_size,
+                                          st.st_mtime_ns).encode('utf-8'))
+    return sig.hexdigest()
+
+
+def _stamp_path(name):
+    return os.path.join(defs.RESULTS_DIR, 'pipeline', name + '.json')
+
+
+def is_fresh(node, sig):
+    '''Has the job been run with these inputs, and are its outputs there?'''
+    if not all(os.path.exists(path) for path in node.outputs):
+        return False
+    path = _stamp_path(node.name)
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'r') as fh:
+        return json.load(fh).get('signature') == sig
+
+
+def write_stamp(node, sig):
+    path = _stamp_path(node.name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as fh:
+        json.dump({'signature': sig}, fh)
+
+
+def matches(graph, targets):
+    '''
+        Return the names of the jobs the targets refer to. A target can be
+        a job name, or the start of some (e.g. 'compare' or
+        'compare-jaccard'), or 'all'.
+    '''
+    unknown = [t for t in targets if t != 'all' and not any(
+        name == t or name.startswith(t + '-') for name in graph)]
+    assert len(unknown) == 0, 'no such job: {}'.format(' '.join(unknown))
+    return [name for name in graph
+            if 'all' in targets or any(name == t or name.startswith(t + '-')
+                                       for t in targets)]
+
+
+def select(graph, targets):
+    '''
+        Return the names of the jobs needed for the targets,
+        with their deps, in graph order.
+    '''
+    wanted = set()
+    todo = matches(graph, targets)
+    while todo:
+        name = todo.pop()
+        if name not in wanted:
+            wanted.add(name)
+            todo.extend(graph[name].deps)
+    return [name for name in graph if name in wanted]
+
+
+def run(graph, targets=('all',), jobs=1, force=False, dry_run=False,
+        by_hash=False):
+    '''
+        Run the jobs needed for the targets, skipping any that are fresh
+        (if force, the targets themselves are run anyway, but not their deps).
+        If jobs > 1, run up to that many at once, in separate processes.
+        If a job fails, the jobs that depend on it are skipped.
+        Return a dict mapping each job name to what happened to it.
+    '''
+    pending = select(graph, targets)
+    forced = set(matches(graph, targets)) if force else set()
+    status = {}
+    running = {}
+    pool = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+
+    def _finish(name, sig, error):
+        if error is None:
+            write_stamp(graph[name], sig)
+            status[name] = 'ran'
+        else:
+            status[name] = 'failed'
+            print('*** {} failed: {}'.format(name, error), file=sys.stderr)
+    try:
+        while pending or running:
+            for name in list(pending):
+                node = graph[name]
+                if any(status.get(d) in ('failed', 'skipped')
+                       for d in node.deps):
+                    pending.remove(name)
+                    status[name] = 'skipped'
+                    continue
+                if not all(d in status for d in node.deps):
+                    continue  # Still waiting for some deps
+                pending.remove(name)
+                sig = signature(node, by_hash)
+                upstream = any(status[d] in ('ran', 'would run')
+                               for d in node.deps)
+                if name not in forced and not (dry_run and upstream) and \
+                        is_fresh(node, sig):
+                    status[name] = 'fresh'
+                elif dry_run:
+                    status[name] = 'would run'
+                elif pool is None:
+                    print('=== Running', name, flush=True)
+                    try:
+                        node.action(*node.args)
+                        _finish(name, sig, None)
+                    except Exception as error:
+                        _finish(name, sig, error)
+                else:
+                    print('=== Starting', name, flush=True)
+                    future = pool.submit(node.action, *node.args)
+                    running[future] = (name, sig)
+            if running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, sig = running.pop(future)
+                    _finish(name, sig, future.exception())
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return status
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Bring the similarity results and graphs up to date.')
+    parser.add_argument('targets', nargs='*', default=['all'],
+                        help='jobs to run, or the start of their names '
+                             '(default: all)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='how many jobs to run at once')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='run the targets even if they are fresh')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='just say which jobs would run')
+    parser.add_argument('--hash', action='store_true',
+                        help='compare input contents, not mtimes')
+    parser.add_argument('--list', action='store_true',
+                        help='list the jobs (same as --dry-run all)')
+    parser.add_argument('--threshold', type=int, default=100,
+                        help='similarity threshold for the cliques')
+    parser.add_argument('--metric', default='jaccard',
+                        choices=defs.ALL_METRICS,
+                        help='metric for the barchart and dot graphs')
+    parser.add_argument('--proc', default='token', choices=defs.ALL_PROCESS,
+                        help='process for the barchart and dot graphs')
+    args = parser.parse_args(argv)
+    graph = build_graph(args.threshold, args.metric, args.proc)
+    if args.list:
+        args.targets, args.dry_run = ['all'], True
+    status = run(graph, args.targets, args.jobs, args.force, args.dry_run,
+                 args.hash)
+    for name, what in status.items():
+        print('{:30s} {}'.format(name, what))
+    return 1 if 'failed' in status.values() else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -6,16 +6,14 @@
 '''
 
 import os
+import warnings
 
 import numpy as np
-import matplotlib.pyplot as plt
 
 import defs
-
-# Make sure we only use Type 1 fonts:
-plt.rc('text', usetex=True)
-plt.rc('font', family='serif')
-plt.rc('axes', labelsize=defs.GRAPH_LABEL_SIZE)
+import compare
+import figures
+import simstore
 
 
 def read_assignment_sim_all(basename):
@@ -25,12 +23,11 @@ def read_assignment_sim_all(basename):
         for all students doing that assignment (vs all other students).
     '''
     inpath = os.path.join(defs.RESULTS_DIR, basename+defs.DATA_SUFFIX)
+    store = simstore.load_results(inpath)
     sims = {a: [] for a in defs.assignments}
-    with open(inpath, 'r') as fh:
-        for line in fh:
-            s1, a1, s2, a2, sim = line.strip().replace('-', ' ').split()
-            if a1 == a2 and s1 != s2:  # Comparison within one project
-                sims[a1].append(int(sim))
+    for a in sims:
+        if (a, a) in store.blocks:  # Comparison within one project
+            sims[a] = store.block(a)[store.pair_mask(a)].tolist()
     return sims
 
 
@@ -41,15 +38,15 @@ def read_assignment_sim_max(basename):
         Return a dict, mapping assignment to list of (max) sim values.
    '''
     inpath = os.path.join(defs.RESULTS_DIR, basename+defs.DATA_SUFFIX)
-    sims = {a: {} for a in defs.assignments}
-    with open(inpath, 'r') as fh:
-        for line in fh:
-            s1, a1, s2, a2, sim = line.strip().replace('-', ' ').split()
-            if a1 == a2 and s1 != s2:  # Comparison within one project
-                if s1 not in sims[a1]:
-                    sims[a1][s1] = -1
-                sims[a1][s1] = max(sims[a1][s1], int(sim))
-    return {a: list(sims[a].values()) for a in defs.assignments}
+    store = simstore.load_results(inpath)
+    sims = {a: [] for a in defs.assignments}
+    for a in sims:
+        if (a, a) in store.blocks:  # Comparison within one project
+            mask = store.pair_mask(a)
+            block = store.block(a).astype(np.int64)
+            maxsims = np.where(mask, block, -1).max(axis=1)
+            sims[a] = maxsims[mask.any(axis=1)].tolist()
+    return sims
 
 
 # #####################################################################
@@ -57,46 +54,97 @@ def read_assignment_sim_max(basename):
 # #####################################################################
 
 
-def _adjacent_values(vals, q1, q3):
-    '''Outliers: return the bounds for +/- 1.5 times the IQR'''
-    upper_adjacent_value = q3 + (q3 - q1) * 1.5
-    upper_adjacent_value = np.clip(upper_adjacent_value, q3, vals[-1])
-    lower_adjacent_value = q1 - (q3 - q1) * 1.5
-    lower_adjacent_value = np.clip(lower_adjacent_value, vals[0], q1)
-    return lower_adjacent_value, upper_adjacent_value
+def violin_stats(data, points=100):
+    '''
+        Work out everything plot_one_violin draws, for all the datasets.
+        The sims are whole percentages, so each dataset is just counted
+        (how many of each value 0-100), and everything is done from that:
+        the quartiles (interpolated, as in np.percentile) and whiskers
+        (1.5*IQR, but within the data) from the cumulative counts.
+        The violins are a Gaussian KDE, with Scott's rule for the bandwidth
+        (as in matplotlib's violinplot), each evaluated at points points,
+        and summed over the 101 values (weighted by their counts).
+        Return (vpstats, quartiles, whiskers): the vpstats are for ax.violin,
+        quartiles has a row (Q1, median, Q3) and whiskers (low, high)
+        for each dataset.
+    '''
+    values = np.arange(101)
+    counts = np.array([np.bincount(np.asarray(d, dtype=np.intp),
+                                   minlength=len(values))
+                       for d in data]).reshape(len(data), len(values))
+    sizes = counts.sum(axis=1)
+    cumulative = counts.cumsum(axis=1)
+    with warnings.catch_warnings():  # Empty datasets just give NaNs
+        warnings.simplefilter('ignore', RuntimeWarning)
+        # The kth value (counting from 0) is the first with more before it:
+        places = (np.array([25, 50, 75]) / 100) * (sizes[:, np.newaxis] - 1)
+        below = np.floor(places)
+        above = np.minimum(below + 1, sizes[:, np.newaxis] - 1)
+        frac = places - below
+        lo, hi = [(cumulative[:, np.newaxis, :] <= k[:, :, np.newaxis])
+                  .sum(axis=2).astype(float) for k in (below, above)]
+        # (Interpolated the same way as np.percentile, to the last bit:)
+        quartiles = np.where(frac >= 0.5, hi - (hi - lo) * (1 - frac),
+                             lo + (hi - lo) * frac)
+        lows = np.argmax(counts > 0, axis=1).astype(float)
+        highs = (values[-1] - np.argmax(counts[:, ::-1] > 0, axis=1)
+                 ).astype(float)
+        means = (counts * values).sum(axis=1) / sizes
+        stds = np.sqrt((counts * (values - means[:, np.newaxis]) ** 2)
+                       .sum(axis=1) / (sizes - 1))
+        bandwidths = stds * sizes ** -0.2
+    empty = sizes == 0
+    quartiles[empty] = lows[empty] = highs[empty] = np.nan
+    q1, q3 = quartiles[:, 0], quartiles[:, 2]
+    whiskers = np.column_stack([np.clip(q1 - (q3 - q1) * 1.5, lows, q1),
+                                np.clip(q3 + (q3 - q1) * 1.5, q3, highs)])
+    vpstats = []
+    for i in range(len(data)):
+        if sizes[i] == 0:
+            coords = vals = np.array([])
+        else:
+            coords = np.linspace(lows[i], highs[i], points)
+            if not bandwidths[i] > 0:  # All the same value (or just one)
+                vals = (coords == lows[i]).astype(float)
+            else:
+                z = (coords[:, np.newaxis] - values) / bandwidths[i]
+                vals = (np.exp(-0.5 * z * z) @ counts[i] /
+                        (sizes[i] * bandwidths[i] * np.sqrt(2 * np.pi)))
+        vpstats.append({'coords': coords, 'vals': vals, 'mean': means[i],
+                        'median': quartiles[i, 1],
+                        'min': lows[i], 'max': highs[i]})
+    return (vpstats, quartiles, whiskers)
 
 
-def plot_one_violin(ax, sims, metric, proc):
+def plot_one_violin(ax, sims, metric, proc, stats=None):
     '''
         Violin plots showing similarities for each project.
         For each violin, show dot for median, bar for the IQR (Q1 to Q3),
         and whiskers for 1.5*IQR.
+        The stats (from violin_stats) are worked out if not given.
     '''
-    data = [sims[a] for a in defs.assignments]
-    parts = ax.violinplot(data, showmeans=False, showmedians=False,
-                          showextrema=False)
+    if stats is None:
+        stats = violin_stats([sims[a] for a in defs.assignments])
+    vpstats, quartiles, whiskers = stats
+    parts = ax.violin(vpstats, showmeans=False, showmedians=False,
+                      showextrema=False)
     # Set the colours for the violin plots:
     for pc in parts['bodies']:
         pc.set_facecolor('#4f90d9')
         pc.set_edgecolor('black')
         pc.set_alpha(1)
-    # Do the quartiles:
-    triples = [np.percentile(d, [25, 50, 75]) for d in data]
-    quartile1, medians, quartile3 = [t for t in zip(*triples)]
-    # Print quartile data to screen, just for confirmation
-    whiskers = np.array([
-        _adjacent_values(sorted_array, q1, q3)
-        for sorted_array, q1, q3 in zip(data, quartile1, quartile3)])
-    whiskersMin, whiskersMax = whiskers[:, 0], whiskers[:, 1]
     # Now draw the median, IQR and whiskers:
-    inds = np.arange(1, len(medians) + 1)
-    ax.scatter(inds, medians, marker='o', color='white', s=30, zorder=3)
-    ax.vlines(inds, quartile1, quartile3, color='k', linestyle='-', lw=5)
-    ax.vlines(inds, whiskersMin, whiskersMax, color='k', linestyle='-', lw=1)
+    inds = np.arange(1, len(quartiles) + 1)
+    ax.scatter(inds, quartiles[:, 1], marker='o', color='white', s=30,
+               zorder=3)
+    ax.vlines(inds, quartiles[:, 0], quartiles[:, 2], color='k',
+              linestyle='-', lw=5)
+    ax.vlines(inds, whiskers[:, 0], whiskers[:, 1], color='k',
+              linestyle='-', lw=1)
 
     # set style for the axes
-    ax.set_title('Version = \\textbf{{{}}}, '.format(proc) +
-                 'similiarity method = \\textbf{{{}}}'.format(metric))
+    ax.set_title('Version = {}, '.format(figures.bold(proc)) +
+                 'similiarity method = {}'.format(figures.bold(metric)))
     ax.set_xlabel('Assignments')
     ax.set_xticks(range(1, 1+len(defs.assignments)))
 #    ax.set_xticklabels([''] + [p.replace('.v', '').replace('_', '\\_')
@@ -106,32 +154,45 @@ def plot_one_violin(ax, sims, metric, proc):
     ax.yaxis.grid(True, linestyle='--', which='major', color='grey', alpha=.25)
 
 
-def plot_assignment_sims(versus_all, save_to_file):
+def plot_assignment_sims(versus_all, save_to_file, preview=False):
     '''
         Plot all the violin plots (all metrics/prcoesses) in a single figure.
         Each subfigure has a violin plot for each assignment.
         Can do all sims per assignment, or just the max sim for each student.
+        If preview, also save a PNG version (see figures.save).
     '''
+    plt = figures.pyplot()
     fig, ax = plt.subplots(nrows=len(defs.ALL_METRICS),
                            ncols=len(defs.ALL_PROCESS),
                            figsize=(20, 15), sharey=True)
     #fig.tight_layout()
     plt.subplots_adjust(hspace=0.3)
     plt.rc('axes', labelsize=defs.GRAPH_LABEL_SIZE)
-    for i, metric in enumerate(defs.ALL_METRICS):
-        for j, proc in enumerate(defs.ALL_PROCESS):
+    data = []
+    for metric in defs.ALL_METRICS:
+        for proc in defs.ALL_PROCESS:
             basename = metric + defs.FILENAME_SEP + proc
             if versus_all:
                 sims = read_assignment_sim_all(basename)
             else:  # Only want max sim value for each student:
                 sims = read_assignment_sim_max(basename)
-            plot_one_violin(ax[i][j], sims, metric, proc)
+            data.extend(sims[a] for a in defs.assignments)
+    # Work out the stats for every subfigure at once:
+    vpstats, quartiles, whiskers = violin_stats(data)
+    n = len(defs.assignments)
+    for i, metric in enumerate(defs.ALL_METRICS):
+        for j, proc in enumerate(defs.ALL_PROCESS):
+            k = (i * len(defs.ALL_PROCESS) + j) * n
+            plot_one_violin(ax[i][j], None, metric, proc,
+                            (vpstats[k:k+n], quartiles[k:k+n],
+                             whiskers[k:k+n]))
     if save_to_file:
         #fig.set_size_inches(12, 6, forward=True)
         basename = defs.FILENAME_SEP.join(['violin',
                                            'all' if versus_all else 'max'])
-        outfile = os.path.join(defs.GRAPHS_DIR, basename + defs.GRAPHS_SUFFIX)
-        plt.savefig(outfile, bbox_inches='tight', pad_inches=0)
+        figures.save(fig, basename, preview, bbox_inches='tight',
+                     pad_inches=0)
+        plt.close(fig)
         print(' Violin plots written to {}'.format(basename))
     else:
         plt.show()
@@ -141,6 +202,28 @@ def plot_assignment_sims(versus_all, save_to_file):
 # Silhouette Code
 # #####################################################################
 
+def _results_path(basename):
+    return os.path.join(defs.RESULTS_DIR, basename+defs.DATA_SUFFIX)
+
+
+def is_blocked(basename):
+    '''
+        Does the results file only have the sims within each assignment
+        (see compare.compare_all_blocked)? If so, it can't be used for
+        the silhouette, which needs the sims between assignments too.
+    '''
+    store = simstore.load_results(_results_path(basename))
+    return not store.full and len(store.rows) > 1
+
+
+def _load_full(basename):
+    '''Load the results file, which must not be blocked'''
+    if is_blocked(basename):
+        raise ValueError('{} only has sims within each assignment; use '
+                         'compare.diff_totals instead'.format(basename))
+    return simstore.load_results(_results_path(basename))
+
+
 def read_diff_totals(basename, pnum):
     '''
         Read the similarity data from one file and group by point & cluster.
@@ -148,46 +231,212 @@ def read_diff_totals(basename, pnum):
         For each (assignment, student), collect the total diffs per cluster.
         Return an map of the difference totals, this looks like
             (assignment, student) -> list-of-diffs-per-assignment
+        The file must not be blocked (see is_blocked).
     '''
+    store = _load_full(basename)
     # Prepare map to hold diff totals per cluster:
     totals = {a: {} for a in defs.assignments}
-    # Now read in the data and fill up the totals array:
-    inpath = os.path.join(defs.RESULTS_DIR, basename+defs.DATA_SUFFIX)
-    with open(inpath, 'r') as fh:
-        for line in fh:
-            s1, a1, s2, a2, sim = line.strip().replace('-', ' ').split()
-            if s1 == s2:  # always ignore self-self comparison
+    for a1 in store.rows:
+        # File has percent similiarity, we want difference, so:
+        diffs = np.zeros((len(store.rows[a1]), len(defs.assignments)),
+                         dtype=np.int64)
+        seen = np.zeros(len(store.rows[a1]), dtype=bool)
+        for a2 in store.cols:
+            if (a1, a2) not in store.blocks:
                 continue
-            if s1 not in totals[a1]:
-                totals[a1][s1] = [0] * len(defs.assignments)
-            # File has percent similiarity, we want difference, so:
-            diff = 100 - int(sim)
-            totals[a1][s1][pnum[a2]] += diff
+            mask = store.pair_mask(a1, a2)  # always ignore self-self
+            diff = np.where(mask, 100 - store.block(a1, a2).astype(np.int64),
+                            0)
+            diffs[:, pnum[a2]] += diff.sum(axis=1)
+            seen |= mask.any(axis=1)
+        for i in np.nonzero(seen)[0]:
+            totals[a1][store.rows[a1][i]] = diffs[i].tolist()
     return totals
 
 
+def silhouette_values(totals, labels, sizes):
+    '''
+        Calculate the silhouette value for every point at once.
+        Given totals[i, c] = total diff from point i to all of cluster c,
+        labels[i] = the cluster of point i, and sizes[c] = no. in cluster c.
+        As in calc_assignment_silhouette, all averages for point i
+        are over the size of its own cluster.
+        Return the values in an np.array, one per point.
+    '''
+    totals = np.asarray(totals, dtype=float)
+    labels = np.asarray(labels)
+    points = np.arange(len(labels))
+    own_size = np.asarray(sizes, dtype=float)[labels]
+    # a(i) value is the average for i's cluster:
+    own_average = totals[points, labels] / (own_size - 1)
+    # b(i) value is min average for all other clusters:
+    oth_averages = totals / own_size[:, np.newaxis]
+    oth_averages[points, labels] = np.inf
+    oth_average = oth_averages.min(axis=1)
+    # s(i) = (b(i) - a(i)) / max((a(i), b(i)))
+    return ((oth_average - own_average)
+            / np.maximum(own_average, oth_average))
+
+
+def silhouette_from_diffs(diffs, labels, sizes):
+    '''
+        Calculate the silhouette values from the full NxN diff matrix
+        (0 wherever there is no comparison), and the cluster labels.
+    '''
+    labels = np.asarray(labels)
+    onehot = np.zeros((len(labels), len(sizes)))
+    onehot[np.arange(len(labels)), labels] = 1
+    return silhouette_values(np.asarray(diffs) @ onehot, labels, sizes)
+
+
+def sample_points(labels, nclusters, nsample, seed=1):
+    '''
+        Pick nsample (random) points from each cluster, or all of them
+        if it is smaller. Return their indices, in order.
+    '''
+    rng = np.random.default_rng(seed)
+    chosen = []
+    for c in range(nclusters):
+        members = np.nonzero(labels == c)[0]
+        if len(members) > 0:
+            chosen.append(rng.choice(members, size=min(nsample, len(members)),
+                                     replace=False))
+    return np.sort(np.concatenate(chosen))
+
+
+def _sampled_diffs(store, a1, start, stop, cols, points, first):
+    '''
+        Return the diffs for rows start:stop of assignment a1, against the
+        sampled points cols (indices into points), as a dense array,
+        with 0 for self-self and missing comparisons (as read_diff_matrix).
+        Only those rows and columns of each block are read from the store.
+    '''
+    diffs = np.zeros((stop - start, len(cols)))
+    students1 = np.array(store.rows[a1][start:stop])
+    for a2 in store.rows:
+        where = np.nonzero([points[k][0] == a2 for k in cols])[0]
+        if len(where) == 0 or (a1, a2) not in store.blocks:
+            continue
+        colnum = {s: j for j, s in enumerate(store.cols[a2])}
+        students2 = [store.rows[a2][cols[k] - first[a2]] for k in where]
+        # Sampled points that were never compared stay at 0:
+        found = [k for k, s in zip(where, students2) if s in colnum]
+        if len(found) == 0:
+            continue
+        js = [colnum[points[cols[k]][1]] for k in found]
+        block = np.asarray(store.block(a1, a2)[start:stop][:, js])
+        same = (students1[:, np.newaxis] ==
+                np.array([store.cols[a2][j] for j in js])[np.newaxis, :])
+        mask = (block != simstore.MISSING) & ~same
+        diffs[:, found] = np.where(mask, 100 - block.astype(np.int64), 0)
+    return diffs
+
+
+def sampled_silhouette(store, pnum, sizes, nsample=50, seed=1, chunk=1000):
+    '''
+        Approximate silhouette values, for when the diff matrix is too big:
+        only use nsample (random) points from each cluster, and scale up
+        to estimate the totals. Only the sampled columns of the store's
+        blocks (which may be memory-mapped) are read, chunk rows at a time,
+        so the full diff matrix is never made.
+        Return (points, values), where points lists the (a, s) pairs.
+    '''
+    points = [(a, s) for a in store.rows for s in store.rows[a]]
+    labels = np.array([pnum[a] for (a, _) in points], dtype=np.int64)
+    first = {}
+    for i, (a, _) in enumerate(points):
+        first.setdefault(a, i)
+    sizes = np.asarray(sizes, dtype=float)
+    cols = sample_points(labels, len(sizes), nsample, seed)
+    onehot = np.zeros((len(cols), len(sizes)))
+    onehot[np.arange(len(cols)), labels[cols]] = 1
+    totals = np.zeros((len(labels), len(sizes)))
+    for a1 in store.rows:
+        for start in range(0, len(store.rows[a1]), chunk):
+            stop = min(start + chunk, len(store.rows[a1]))
+            block = _sampled_diffs(store, a1, start, stop, cols, points,
+                                   first)
+            rows = np.arange(first[a1] + start, first[a1] + stop)
+            notself = rows[:, np.newaxis] != cols[np.newaxis, :]
+            sums = (block * notself) @ onehot
+            counts = notself @ onehot
+            # Average diff to each cluster, times no. of other points in it:
+            others = sizes[np.newaxis, :] - (labels[rows, np.newaxis] ==
+                                             np.arange(len(sizes)))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                totals[rows] = (np.where(counts > 0, sums / counts, 0) *
+                                others)
+    return (points, silhouette_values(totals, labels, sizes))
+
+
+def read_diff_matrix(basename, pnum):
+    '''
+        Read the similarity data from one file into a full diff matrix.
+        Here we assume: point=(assignment, student) and cluster=assignment.
+        Return (points, labels, diffs) where points lists the (a, s) pairs,
+        labels gives the cluster number for each, and diffs is NxN,
+        with 0 for self-self (and any other missing) comparisons.
+        The file must not be blocked (see is_blocked).
+    '''
+    store = _load_full(basename)
+    points = [(a, s) for a in store.rows for s in store.rows[a]]
+    labels = np.array([pnum[a] for (a, _) in points], dtype=np.int64)
+    first = {}
+    for i, (a, _) in enumerate(points):
+        first.setdefault(a, i)
+    diffs = np.zeros((len(points), len(points)))
+    for (a1, a2), block in store.blocks.items():
+        if a2 not in first:
+            continue
+        # Only columns which are also rows (i.e. points):
+        colnum = {s: j for j, s in enumerate(store.rows[a2])}
+        cols = [j for j, s in enumerate(store.cols[a2]) if s in colnum]
+        where = [first[a2] + colnum[store.cols[a2][j]] for j in cols]
+        mask = store.pair_mask(a1, a2)[:, cols]
+        diff = np.where(mask, 100 - block[:, cols].astype(np.int64), 0)
+        diffs[first[a1]:first[a1]+len(store.rows[a1]), where] = diff
+    return (points, labels, diffs)
+
+
 def calc_assignment_silhouette(totals, pnum):
     '''
         Calculate the silhouette value for each point=(assignment, student).
         Given totals, mapping assign x student x assign -> diff
         See: https://en.wikipedia.org/wiki/Silhouette_(clustering)
-        Return the values in an np.array, shape = #assignments, #students
+        Return the values in a dict, mapping assignment to student to value.
     '''
     attempts = defs.did_assignment()
+    sizes = [attempts[a] for a in defs.assignments]
+    # student didn't do this assignment if not in totals:
+    points = [(a, s) for a in defs.assignments
+              for s in defs.students if s in totals[a]]
     silhouette = {p: {} for p in defs.assignments}
-    for a in defs.assignments:
-        for s in defs.students:
-            if s not in totals[a]:  # student didn't do this assignment
-                continue
-            oth_totals = totals[a][s].copy()
-            #  a(i) value is the average for a's cluster:
-            own_total = oth_totals.pop(pnum[a])
-            own_average = own_total / (attempts[a] - 1)
-            # b(i) value is min average for all other clusters:
-            oth_average = min([t/attempts[a] for t in oth_totals])
-            # s(i) = (b(i) - a(i)) / max((a(i), b(i)))
-            silhouette[a][s] = ((oth_average - own_average)
-                                / max(own_average, oth_average))
+    if len(points) == 0:
+        return silhouette
+    labels = [pnum[a] for (a, _) in points]
+    values = silhouette_values([totals[a][s] for (a, s) in points],
+                               labels, sizes)
+    for (a, s), value in zip(points, values.tolist()):
+        silhouette[a][s] = value
+    return silhouette
+
+
+def calc_sampled_silhouette(basename, pnum, nsample, seed=1):
+    '''
+        Same as calc_assignment_silhouette (from the data file), but
+        approximate, using only nsample students from each assignment.
+    '''
+    attempts = defs.did_assignment()
+    sizes = [attempts[a] for a in defs.assignments]
+    store = _load_full(basename)
+    silhouette = {p: {} for p in defs.assignments}
+    if len(store.rows) == 0:
+        return silhouette
+    points, values = sampled_silhouette(store, pnum, sizes, nsample, seed)
+    students = set(defs.students)
+    for (a, s), value in zip(points, values.tolist()):
+        if s in students:
+            silhouette[a][s] = value
     return silhouette
 
 
@@ -207,15 +456,33 @@ def print_silhouette(silhouette):
     print(cluster_sil)
 
 
-def calc_silhouette():
+def calc_silhouette(from_dat=True, nsample=None):
+    '''
+        Print the average silhouette value per assignment for each
+        metric/process. If not from_dat, or the .dat file is blocked,
+        the diff totals are calculated from the source files.
+        If nsample is given, use the sampled (approximate) silhouette
+        from the .dat file (if it can be used, as above).
+    '''
     # Number the assignments and students:
     num_assignments = len(defs.assignments)
     pnum = dict(zip(defs.assignments, range(num_assignments)))
+    corpus = compare.Corpus()
     for metric in defs.ALL_METRICS:
         for proc in defs.ALL_PROCESS:
             basename = metric + defs.FILENAME_SEP + proc
-            totals = read_diff_totals(basename, pnum)
-            silhouette = calc_assignment_silhouette(totals, pnum)
+            if from_dat and not is_blocked(basename):
+                if nsample is not None:
+                    silhouette = calc_sampled_silhouette(basename, pnum,
+                                                         nsample)
+                else:
+                    totals = read_diff_totals(basename, pnum)
+                    silhouette = calc_assignment_silhouette(totals, pnum)
+            else:
+                cmpfunc = compare.METRICS[metric].cmpfunc
+                totals = compare.diff_totals(defs.latest_dir(proc),
+                                             cmpfunc, corpus)
+                silhouette = calc_assignment_silhouette(totals, pnum)
             print('{:15s}'.format(basename), end=' ')
             for a in defs.assignments:
                 aavg = (sum(silhouette[a].values()) /
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+'''
+    Make the orig, clean and token versions of each Verilog file
+    in one pass: each source is read once, and all three are made in memory.
+        orig:   the file as copied (header and blank lines removed)
+        clean:  with the comments stripped out
+        token:  the clean version, with each line cut into tokens
+                (identifiers, numbers, strings made canonical),
+                separated by single spaces
+    The comment stripper and tokenizer can be replaced by any function
+    that maps a list of lines to a list of lines.
+    The versions are given straight to a compare.Corpus, so the comparisons
+    can run without them being written out; writing them is optional,
+    but anything run later on its own (e.g. incremental) reads the files.
+'''
+
+import os
+
+import defs
+import compare
+import specials
+import verilog
+
+# The default comment stripper and tokenizer (see verilog):
+strip_comments = verilog.strip_comments
+tokenize = verilog.tokenizer()
+
+
+def variants(lines, stripper=strip_comments, tokenizer=tokenize):
+    '''Return a dict mapping each kind of processing to the lines'''
+    clean = stripper(lines)
+    return {'orig': lines, 'clean': clean, 'token': tokenizer(clean)}
+
+
+def preprocess(sources, omit_first=True,
+               stripper=strip_comments, tokenizer=tokenize):
+    '''
+        Given (source_dir, oldfilename, newfilename) triples, read each file
+        once, and yield (newfilename, variants) for it (see variants).
+    '''
+    for source_dir, oldfilename, newfilename in sources:
+        lines = compare.read_source(source_dir, oldfilename, omit_first)
+        yield (newfilename, variants(lines, stripper, tokenizer))
+
+
+def latest_sources(students):
+    '''The source triples for the latest version of each students' files'''
+    for oldfilename, newfilename in compare.latest_files(students):
+        yield (defs.DATAROOT, oldfilename, newfilename)
+
+
+def special_sources():
+    '''The source triples for the special files (see specials)'''
+    for special_kind in defs.ALL_SPECIALS:
+        src_dir = defs.special_src[special_kind]
+        _, _, files = next(os.walk(src_dir))
+        for vfilename in files:
+            if vfilename.endswith(defs.VERILOG_SUFFIX):
+                newfilename = special_kind + defs.FILENAME_SEP + vfilename
+                yield (src_dir, vfilename, newfilename)
+
+
+def load_versions(corpus, sources, target_dir, omit_first=True, write=False,
+                  stripper=strip_comments, tokenizer=tokenize):
+    '''
+        Preprocess the sources, and give all the versions to the corpus.
+        The version for proc goes in target_dir(proc).
+        If write, also write them there (as compare.copy_file would).
+    '''
+    for proc in defs.ALL_PROCESS:  # The results go beside these
+        os.makedirs(target_dir(proc), exist_ok=True)
+    count = 0
+    for newfilename, versions in preprocess(sources, omit_first,
+                                            stripper, tokenizer):
+        for proc, lines in versions.items():
+            if write:
+                compare.write_lines(target_dir(proc), newfilename, lines)
+            corpus.add_file(target_dir(proc), newfilename,
+                            compare.as_read(lines))
+        count += 1
+    return count
+
+
+def load_all(corpus=None, write=False,
+             stripper=strip_comments, tokenizer=tokenize):
+    '''
+        Preprocess the latest student files and the specials.
+        Return the corpus, ready for compare and specials to use.
+    '''
+    if corpus is None:
+        corpus = compare.Corpus()
+    students = compare.get_index(defs.DATAROOT)
+    print('Read data for', len(students.student_ids), 'students.')
+    count = load_versions(corpus, latest_sources(students), defs.latest_dir,
+                          True, write, stripper, tokenizer)
+    count += load_versions(corpus, special_sources(), defs.special_dir,
+                           False, write, stripper, tokenizer)
+    print('Preprocessed {} files.'.format(count))
+    return corpus
+
+
+function = 1
+if __name__ == '__main__':
+    if function == 1:
+        # Write them too: defs, cliques and incremental read the latest dirs
+        corpus = load_all(write=True)
+        compare.do_all_compare(corpus)
+        specials.compare_specials(corpus=corpus)
@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+'''
+    Check that the faster comparison engines give exactly the same
+    results as the original one (compare_all, one pair at a time),
+    on a synthetic cohort (see bench.make_cohort):
+        compare_all_fast      sparse matrix / sequence engines
+        compare_all_parallel  the same, sharded over worker processes
+        compare_all_cached    through a PairCache, empty and then warm
+        compare_all_blocked   (only the same-assignment pairs)
+        compare_all_store     straight to a SimStore, full and blocked
+        threshold_pairs       (only the pairs at or above a threshold)
+    for every metric, over the latest files for every process.
+    Run it after changing any of them: it prints each check, and
+    returns (and exits with) the number that failed.
+'''
+
+import io
+import os
+import sys
+import tempfile
+
+from contextlib import redirect_stdout
+
+import defs
+import bench
+import compare
+import paircache
+import preprocess
+
+
+def _same_assignment(triples):
+    return [t for t in triples
+            if t[0].split(defs.FILENAME_SEP, 1)[1] ==
+            t[1].split(defs.FILENAME_SEP, 1)[1]]
+
+
+def _pairs_over(triples, threshold):
+    '''The (student, student) pairs in the triples, as threshold_pairs has'''
+    pairs = {}
+    for fn1, fn2, sim in triples:
+        s1, a = fn1.split(defs.FILENAME_SEP, 1)
+        s2, a2 = fn2.split(defs.FILENAME_SEP, 1)
+        if sim >= threshold and a == a2 and s1 != s2:
+            pairs.setdefault(a, set()).add((s1, s2))
+    return pairs
+
+
+def check_engines(nstudents=40, nassign=4, seed=1, workers=2, threshold=50):
+    '''
+        Make a cohort in a temporary directory, and compare every engine
+        against compare_all on it. Return the number of checks that failed.
+    '''
+    failed = 0
+
+    def _check(what, expected, engine, *args):
+        nonlocal failed
+        with redirect_stdout(io.StringIO()):  # No progress from the engine
+            got = engine(*args)
+        ok = (expected == got)
+        failed += not ok
+        print('{:50s} {}'.format(what, 'ok' if ok else 'DIFFERENT'))
+    with tempfile.TemporaryDirectory(prefix='regress-') as root:
+        students, assignments = bench.make_cohort(root, nstudents, nassign,
+                                                  seed=seed)
+        old = bench.use_tree(root, students, assignments)
+        try:
+            corpus = preprocess.load_all(write=True)
+            cache = paircache.PairCache(os.path.join(root, 'cache.db'))
+            dirs = [defs.latest_dir(p) for p in defs.ALL_PROCESS]
+            pool = compare.start_pool(compare.Corpus(), workers, dirs)
+            for metric in defs.ALL_METRICS:
+                cmpfunc = compare.METRICS[metric].cmpfunc
+                for proc in defs.ALL_PROCESS:
+                    src_dir = defs.latest_dir(proc)
+                    name = metric + defs.FILENAME_SEP + proc
+
+                    def _vfile(filename):
+                        return filename.endswith(defs.VERILOG_SUFFIX)
+                    expected = compare.compare_all(src_dir, _vfile, cmpfunc,
+                                                   compare.Corpus())
+                    print()  # After compare_all's progress
+                    _check(name + ' fast', expected, compare.compare_all_fast,
+                           src_dir, _vfile, cmpfunc, corpus)
+                    _check(name + ' parallel', expected,
+                           compare.compare_all_parallel,
+                           src_dir, _vfile, cmpfunc, pool, 4 * workers)
+                    for run in ['cold', 'warm']:
+                        _check('{} cached ({})'.format(name, run), expected,
+                               compare.compare_all_cached,
+                               src_dir, _vfile, cmpfunc, corpus, cache)
+                    _check(name + ' blocked', _same_assignment(expected),
+                           compare.compare_all_blocked,
+                           src_dir, _vfile, cmpfunc, corpus)
+                    if cmpfunc in compare.MATRIX_METRICS:
+                        for blocked in [False, True]:
+                            _check('{} store{}'.format(
+                                       name, ' (blocked)' if blocked else ''),
+                                   _same_assignment(expected) if blocked
+                                   else expected,
+                                   lambda: compare.compare_all_store(
+                                       src_dir, _vfile, cmpfunc, corpus,
+                                       blocked).triples())
+
+                    def _threshold_pairs():
+                        pairs = compare.threshold_pairs(src_dir, cmpfunc,
+                                                        threshold, corpus)
+                        return {a: set(p) for a, p in pairs.items() if p}
+                    _check('{} threshold {}'.format(name, threshold),
+                           _pairs_over(expected, threshold), _threshold_pairs)
+            pool.shutdown()
+            cache.close()
+        finally:
+            bench.restore_defs(old)
+    print('{} checks failed.'.format(failed))
+    return failed
+
+
+function = 1
+if __name__ == '__main__':
+    if function == 1:
+        sys.exit(check_engines())
+    elif function == 2:  # Bigger, and a different cohort
+        sys.exit(check_engines(nstudents=100, nassign=6, seed=2))
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+'''
+    Render all the figures (violin plots, special violin plots, the
+    clique barchart and the dot graphs) in parallel, over a process pool.
+    Each figure is a separate task, so the slow ones (the 3x3 violin
+    grids, especially with usetex) run at the same time as the rest.
+    The cliques are worked out once, here, and passed to the tasks.
+    With preview, PNG versions are also written (see figures.save).
+'''
+
+import sys
+
+from concurrent.futures import ProcessPoolExecutor
+
+import defs
+import cliques
+import specials
+
+
+# The tasks (at module level, so they can be run in other processes):
+
+def _violins(versus_all, preview):
+    import plot_graphs
+    plot_graphs.plot_assignment_sims(versus_all, True, preview)
+
+
+def _special_violins(special_kind, metric, proc, preview):
+    specials.plot_special_sims(special_kind, metric, [proc], preview)
+
+
+def _barchart(over, preview):
+    cliques.barchart_cliques(over, True, preview)
+
+
+def _dot(assign, over, under, dotargs):
+    cliques.dotgraph_cliques(over, under, [assign], **dotargs)
+
+
+def render_tasks(metric='jaccard', proc='token', threshold=100,
+                 preview=False, dotargs={}):
+    '''
+        Return a list of (name, func, args) for all the figures.
+        The barchart and dot graphs are for this metric, proc and threshold;
+        there is one dot graph task per assignment, and any dotargs
+        (e.g. how, top_k, floor, engine) go to cliques.dotgraph_cliques.
+    '''
+    tasks = [('violins-all', _violins, (True, preview)),
+             ('violins-max', _violins, (False, preview))]
+    for special_kind in defs.ALL_SPECIALS:
+        for p in defs.ALL_PROCESS:
+            tasks.append(('violins-{}-{}'.format(special_kind, p),
+                          _special_violins,
+                          (special_kind, metric, p, preview)))
+    over, under = cliques.get_cliques(metric, proc, threshold)
+    tasks.append(('barchart', _barchart, (over, preview)))
+    for a in defs.assignments:
+        tasks.append(('dot-' + a.replace(defs.VERILOG_SUFFIX, ''), _dot,
+                      (a, {a: over[a]}, {a: under[a]}, dotargs)))
+    return tasks
+
+
+def render_all(workers=4, metric='jaccard', proc='token', threshold=100,
+               preview=False, dotargs={}):
+    '''
+        Render all the figures, using up to workers processes
+        (or none, if workers is 1). A task that fails is reported, but
+        the others still run. Return the names of the failed tasks.
+    '''
+    tasks = render_tasks(metric, proc, threshold, preview, dotargs)
+    failed = []
+
+    def _failed(name, error):
+        failed.append(name)
+        print('*** {} failed: {}'.format(name, error), file=sys.stderr)
+    if workers == 1:
+        for name, func, args in tasks:
+            try:
+                func(*args)
+            except Exception as error:
+                _failed(name, error)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [(name, pool.submit(func, *args))
+                       for name, func, args in tasks]
+            for name, future in futures:
+                if future.exception() is not None:
+                    _failed(name, future.exception())
+    print('Rendered {} of {} figures.'.format(len(tasks) - len(failed),
+                                              len(tasks)))
+    return failed
+
+
+function = 1
+if __name__ == '__main__':
+    if function == 1:
+        render_all()
+    elif function == 2:  # Quick look: PNG previews too
+        render_all(preview=True)
+    elif function == 3:  # Big cohorts: prune the dot graphs, use sfdp
+        render_all(threshold=50, dotargs={'how': 'max', 'top_k': 3,
+                                          'engine': 'sfdp'})
@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+'''
+    Threshold similarity joins over sets of line IDs.
+    Rather than scoring every pair of files, find just the candidate pairs
+    that could reach the threshold, using size bounds and prefix filtering
+    (as in the All-Pairs algorithm of Bayardo et al., WWW 2007).
+    Every candidate pair must still be checked with the exact metric.
+    Thresholds are percentages, as in the .dat files.
+'''
+
+import math
+
+from collections import Counter
+
+
+def min_sim(threshold):
+    '''
+        The smallest similarity (a fraction) that could round to threshold%.
+        Make it a bit smaller again, so float error can't lose a pair.
+    '''
+    return max(0.0, (threshold - 0.5) / 100 - 1e-9)
+
+
+def _order_by_rarity(idsets1, idsets2):
+    '''
+        Sort each set of IDs so the rarest (over both lists) come first.
+        Then the prefixes of the sets are as selective as possible.
+    '''
+    counts = Counter()
+    for ids in idsets1 + idsets2:
+        counts.update(ids)
+
+    def _rarity(lid):
+        return (counts[lid], lid)
+    return ([sorted(ids, key=_rarity) for ids in idsets1],
+            [sorted(ids, key=_rarity) for ids in idsets2])
+
+
+def _prefix_len(size, smin):
+    '''
+        If two sets must have at least ceil(smin*size) IDs in common,
+        they must share an ID in the first prefix_len IDs of this one.
+    '''
+    return size - math.ceil(smin * size) + 1
+
+
+def _all_pairs(idsets1, idsets2):
+    '''Every pair of non-empty sets is a candidate'''
+    return [(i, j) for i, ids1 in enumerate(idsets1) if ids1
+            for j, ids2 in enumerate(idsets2) if ids2]
+
+
+def jaccard_candidates(idsets1, idsets2, threshold):
+    '''
+        Return the pairs (i, j) where idsets1[i] and idsets2[j] might have
+        a Jaccard similarity >= threshold%. Empty sets are never paired.
+        Uses the size bound smin*|x| <= |y| <= |x|/smin, and the fact that
+        J(x, y) >= smin means both prefixes must share an ID.
+    '''
+    smin = min_sim(threshold)
+    if smin == 0:
+        return _all_pairs(idsets1, idsets2)
+    sorted1, sorted2 = _order_by_rarity(idsets1, idsets2)
+    index = {}  # Map IDs in the prefix of each idsets2 set to set numbers
+    for j, ids in enumerate(sorted2):
+        for lid in ids[:_prefix_len(len(ids), smin)]:
+            index.setdefault(lid, []).append(j)
+    pairs = set()
+    for i, ids in enumerate(sorted1):
+        lo, hi = smin * len(ids), len(ids) / smin
+        for lid in ids[:_prefix_len(len(ids), smin)]:
+            for j in index.get(lid, []):
+                if lo <= len(sorted2[j]) <= hi:
+                    pairs.add((i, j))
+    return sorted(pairs)
+
+
+def tversky_candidates(idsets1, idsets2, threshold):
+    '''
+        Return the pairs (i, j) where idsets1[i] and idsets2[j] might have
+        an asymmetric Tversky similarity (|x & y| / |x|) >= threshold%.
+        Only x is bounded here, so we index all of y, but probe with
+        x's prefix, and y must have at least smin*|x| IDs.
+    '''
+    smin = min_sim(threshold)
+    if smin == 0:
+        return _all_pairs(idsets1, idsets2)
+    sorted1, sorted2 = _order_by_rarity(idsets1, idsets2)
+    index = {}  # Map every ID in each idsets2 set to set numbers
+    for j, ids in enumerate(sorted2):
+        for lid in ids:
+            index.setdefault(lid, []).append(j)
+    pairs = set()
+    for i, ids in enumerate(sorted1):
+        lo = smin * len(ids)
+        for lid in ids[:_prefix_len(len(ids), smin)]:
+            for j in index.get(lid, []):
+                if len(sorted2[j]) >= lo:
+                    pairs.add((i, j))
+    return sorted(pairs)
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+'''
+    Vectorised all-pairs similarity for the set-based metrics.
+    Each file is a row in a (files x line IDs) 0/1 incidence matrix,
+    so one sparse matrix product gives the number of lines in common
+    for every pair of files. The metrics are then worked out
+    from these counts and the number of (distinct) lines in each file.
+'''
+
+import numpy as np
+
+
+def compact_ids(idlists1, idlists2):
+    '''
+        Number the IDs used in these lists 0, 1, 2, ... (in order),
+        so they can be the columns of the incidence matrices.
+        Return (idlists1, idlists2, num_ids), with the new numbers.
+    '''
+    idlists = list(idlists1) + list(idlists2)
+    if len(idlists) == 0:
+        return ([], [], 0)
+    allids = np.concatenate([np.asarray(ids, dtype=np.int64)
+                             for ids in idlists])
+    distinct, cols = np.unique(allids, return_inverse=True)
+    parts = np.split(cols, np.cumsum([len(ids) for ids in idlists])[:-1])
+    return (parts[:len(idlists1)], parts[len(idlists1):], len(distinct))
+
+
+def incidence_matrix(idlists, num_ids):
+    '''
+        Given a list of line-ID lists (one per file), return a sparse
+        0/1 matrix with one row per file and one column per line ID.
+    '''
+    from scipy import sparse  # Slow to import, so only when needed
+    indptr = np.zeros(len(idlists)+1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(ids) for ids in idlists])
+    if len(idlists) > 0:
+        indices = np.concatenate([np.asarray(ids, dtype=np.int64)
+                                  for ids in idlists])
+    else:
+        indices = np.zeros(0, dtype=np.int64)
+    data = np.ones(len(indices), dtype=np.int32)
+    return sparse.csr_matrix((data, indices, indptr),
+                             shape=(len(idlists), num_ids))
+
+
+def common_counts(idlists1, idlists2, num_ids):
+    '''
+        Count the line IDs in common between every pair of files.
+        Return (common, sizes1, sizes2), where common[i, j] is the count
+        for file i of idlists1 vs file j of idlists2.
+    '''
+    m1 = incidence_matrix(idlists1, num_ids)
+    m2 = incidence_matrix(idlists2, num_ids)
+    common = (m1 @ m2.T).toarray()
+    sizes1 = np.asarray(m1.sum(axis=1)).ravel()
+    sizes2 = np.asarray(m2.sum(axis=1)).ravel()
+    return (common, sizes1, sizes2)
+
+
+def tversky_matrix(common, sizes1, sizes2, alpha, beta):
+    '''Calculate the Tversky distance for all pairs from the counts'''
+    xmy = sizes1[:, np.newaxis] - common
+    ymx = sizes2[np.newaxis, :] - common
+    denom = common + (alpha * xmy) + (beta * ymx)
+    return common / denom
+
+
+def jaccard_matrix(common, sizes1, sizes2):
+    '''Calculate the Jaccard distance for all pairs from the counts'''
+    return tversky_matrix(common, sizes1, sizes2, alpha=1, beta=1)
+
+
+def tv_asymmetric_matrix(common, sizes1, sizes2):
+    '''Calculate the distance for all pairs as a prop of the first'''
+    return tversky_matrix(common, sizes1, sizes2, alpha=1, beta=0)
+
+
+def count_common_matrix(common, sizes1, sizes2):
+    '''Return the number of lines in common for all pairs'''
+    return common
+
+
+def percentages(sims):
+    '''
+        Convert similarities to integer percentages,
+        rounding the same way as round() does (half to even).
+    '''
+    return np.rint(sims * 100).astype(np.int64)
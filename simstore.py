@@ -0,0 +1,500 @@
+#!/usr/bin/python3
+'''
+    A compact binary store for the similarity results,
+    as an alternative to the text (.dat) files of triples.
+    The file has a short header, giving (for each assignment) the
+    row and column names, i.e. the student ids (or special kinds).
+    After that come the sims, as uint8 matrices, one per block:
+        - within each assignment: rows[a] x cols[a]
+        - (if full) also between assignments: rows[a1] x cols[a2]
+    Each block is read straight from disk using numpy.memmap.
+    Any pair that was not compared (e.g. an empty file) is MISSING.
+'''
+
+import os
+import re
+import json
+import struct
+
+import numpy as np
+
+import defs
+import instrument
+
+MAGIC = b'SIM1'
+
+# Value for pairs that have no similarity (can't be a percentage):
+MISSING = 255
+
+# Blocks start on a multiple of this many bytes:
+_ALIGN = 8
+
+
+def _split(filename):
+    '''Split a name like XXX-Filename.v into (XXX, Filename.v)'''
+    return tuple(filename.split(defs.FILENAME_SEP, 1))
+
+
+def _block_order(rows, cols, full):
+    '''List the blocks (a1, a2) in the order they are in the file'''
+    return [(a1, a2) for a1 in rows
+            for a2 in (cols if full else [a1]) if a2 in cols]
+
+
+def _check_sim(fn1, fn2, sim):
+    if not 0 <= sim <= 100:
+        raise ValueError('not a percentage: {} {} {}'.format(fn1, fn2, sim))
+
+
+class SimStore:
+    '''
+        The sims from one results file, indexed by assignment.
+        For each assignment a: rows[a] and cols[a] list the student ids,
+        and blocks[(a1, a2)] is the matrix of sims for rows[a1] x cols[a2].
+        These may be memory-mapped (see read_store), so read only when used.
+    '''
+    def __init__(self, rows, cols, full, blocks):
+        self.rows = rows
+        self.cols = cols
+        self.full = full
+        self.blocks = blocks
+
+    def block(self, a1, a2=None):
+        '''
+            Return the matrix of sims for rows in a1 vs columns in a2.
+            Rows are in the order of self.rows[a1], columns self.cols[a2].
+        '''
+        return self.blocks[(a1, a1 if a2 is None else a2)]
+
+    def __len__(self):
+        '''The number of sims, i.e. of pairs that were compared'''
+        return sum(int(np.count_nonzero(block != MISSING))
+                   for block in self.blocks.values())
+
+    def pair_mask(self, a1, a2=None):
+        '''
+            Which entries of this block are real comparisons,
+            i.e. not MISSING and not a student compared with themselves.
+        '''
+        a2 = a1 if a2 is None else a2
+        same = (np.array(self.rows[a1])[:, np.newaxis] ==
+                np.array(self.cols[a2])[np.newaxis, :])
+        return (self.block(a1, a2) != MISSING) & ~same
+
+    def triples(self):
+        '''Return the (non-missing) sims as (file1, file2, similarity)'''
+        metrics = []
+        for (a1, a2), block in self.blocks.items():
+            for i, j in zip(*np.nonzero(block != MISSING)):
+                metrics.append((self.rows[a1][i] + defs.FILENAME_SEP + a1,
+                                self.cols[a2][j] + defs.FILENAME_SEP + a2,
+                                int(block[i, j])))
+        return sorted(metrics, key=lambda t: t[0]+t[1])
+
+
+def _aligned(nbytes):
+    '''Round up to the next block boundary'''
+    return -(-nbytes // _ALIGN) * _ALIGN
+
+
+def _order(assignments):
+    '''The assignments in the order they go in the file'''
+    order = [a for a in defs.assignments if a in assignments]
+    return order + sorted(set(assignments) - set(order))
+
+
+def _positions(names, anum, filenum):
+    '''
+        For each file (numbered as in filenum), return its assignment's
+        number (from anum, or -1 if it isn't in names) and its position
+        in names[assignment], as two arrays.
+    '''
+    assign = np.full(len(filenum), -1, dtype=np.int64)
+    pos = np.zeros(len(filenum), dtype=np.int64)
+    for a, students in names.items():
+        for i, s in enumerate(students):
+            k = filenum[s + defs.FILENAME_SEP + a]
+            assign[k], pos[k] = anum[a], i
+    return (assign, pos)
+
+
+# One entry per triple: the numbers of its two files, and its sim
+_ENTRY = np.dtype([('file1', np.int64), ('file2', np.int64),
+                   ('sim', np.int64)])
+
+
+def make_store(metrics, full=None):
+    '''
+        Put a list of triples (file1, file2, similarity) into a SimStore.
+        If full, keep the sims between different assignments as well;
+        by default, only do this if there are any in the triples.
+        The sims must be percentages (MISSING is not allowed either).
+        The triples are only gone through once (giving each file name
+        a number); the sims are then put in place all at once.
+    '''
+    filenum = {}
+    entries = np.fromiter(((filenum.setdefault(fn1, len(filenum)),
+                            filenum.setdefault(fn2, len(filenum)), sim)
+                           for fn1, fn2, sim in metrics), dtype=_ENTRY)
+    files = list(filenum)
+    bad = (entries['sim'] < 0) | (entries['sim'] > 100)
+    if bad.any():
+        fn1, fn2, sim = entries[np.argmax(bad)]
+        _check_sim(files[fn1], files[fn2], sim)
+    rows, cols = {}, {}
+    for k in np.unique(entries['file1']).tolist():
+        s1, a1 = _split(files[k])
+        rows.setdefault(a1, set()).add(s1)
+    for k in np.unique(entries['file2']).tolist():
+        s2, a2 = _split(files[k])
+        cols.setdefault(a2, set()).add(s2)
+    order = _order(set(rows) | set(cols))
+    rows = {a: sorted(rows[a]) for a in order if a in rows}
+    cols = {a: sorted(cols[a]) for a in order if a in cols}
+    anum = {a: n for n, a in enumerate(order)}
+    rowa, rowi = _positions(rows, anum, filenum)
+    cola, colj = _positions(cols, anum, filenum)
+    f1, f2 = entries['file1'], entries['file2']
+    if full is None:
+        full = bool((rowa[f1] != cola[f2]).any())
+    full = bool(full)
+    # The blocks all go in one buffer, laid out as in the file:
+    order = _block_order(rows, cols, full)
+    blocknum = np.full((len(anum), len(anum)), -1, dtype=np.int64)
+    offsets = np.zeros(len(order), dtype=np.int64)
+    widths = np.zeros(len(order), dtype=np.int64)
+    size = 0
+    for n, (a1, a2) in enumerate(order):
+        blocknum[anum[a1], anum[a2]] = n
+        offsets[n], widths[n] = size, len(cols[a2])
+        size += len(rows[a1]) * len(cols[a2])
+    data = np.full(size, MISSING, dtype=np.uint8)
+    n = blocknum[rowa[f1], cola[f2]]
+    keep = (n >= 0)
+    n = n[keep]
+    data[offsets[n] + rowi[f1[keep]] * widths[n] + colj[f2[keep]]] = \
+        entries['sim'][keep]
+    blocks = {}
+    for (a1, a2), offset in zip(order, offsets.tolist()):
+        shape = (len(rows[a1]), len(cols[a2]))
+        blocks[(a1, a2)] = data[offset:offset+shape[0]*shape[1]].reshape(
+            shape)
+    return SimStore(rows, cols, full, blocks)
+
+
+def matrix_store(parts, full):
+    '''
+        Make a SimStore straight from matrices of sims, without any
+        triples: each part is (files1, files2, sims), where sims is
+        the matrix (of percentages) for files1 x files2, which are named
+        like XXX-Filename.v. Each assignment's rows (and columns) must
+        all be in one part, e.g. one part for everything, or (if not full)
+        one part for each assignment, compared with itself.
+    '''
+    rows, cols = {}, {}
+    blocks = {}
+    for files1, files2, sims in parts:
+        sims = np.asarray(sims)
+        if sims.size > 0 and not 0 <= sims.min() <= sims.max() <= 100:
+            raise ValueError('not a percentage: {}'.format(
+                sims[(sims < 0) | (sims > 100)][0]))
+        rowsof, colsof = {}, {}
+        for i, fn1 in enumerate(files1):
+            s1, a1 = _split(fn1)
+            rowsof.setdefault(a1, []).append((s1, i))
+        for j, fn2 in enumerate(files2):
+            s2, a2 = _split(fn2)
+            colsof.setdefault(a2, []).append((s2, j))
+        for a1 in rowsof:
+            rowsof[a1].sort()
+            rows[a1] = [s1 for (s1, _) in rowsof[a1]]
+        for a2 in colsof:
+            colsof[a2].sort()
+            cols[a2] = [s2 for (s2, _) in colsof[a2]]
+        for a1, rowlist in rowsof.items():
+            for a2, collist in colsof.items():
+                if full or a1 == a2:
+                    blocks[(a1, a2)] = sims[np.ix_(
+                        [i for (_, i) in rowlist],
+                        [j for (_, j) in collist])].astype(np.uint8)
+    order = _order(set(rows) | set(cols))
+    rows = {a: rows[a] for a in order if a in rows}
+    cols = {a: cols[a] for a in order if a in cols}
+    return SimStore(rows, cols, bool(full), blocks)
+
+
+def save_store(path, store):
+    '''Write a SimStore to a binary file'''
+    header = json.dumps({'rows': store.rows, 'cols': store.cols,
+                         'full': store.full})
+    header = header.encode('utf-8')
+    with open(path, 'wb') as fh:
+        fh.write(struct.pack('<4sI', MAGIC, len(header)))
+        fh.write(header)
+        fh.write(b'\0' * (_aligned(8 + len(header)) - 8 - len(header)))
+        for key in _block_order(store.rows, store.cols, store.full):
+            fh.write(store.blocks[key].tobytes())
+
+
+def write_store(path, metrics, full=None):
+    '''
+        Write a list of triples (file1, file2, similarity) to a binary file.
+        The full flag is as for make_store.
+    '''
+    save_store(path, make_store(metrics, full))
+
+
+@instrument.timed('read_store')
+def read_store(path, mode='r'):
+    '''
+        Open a binary file of sims, return a SimStore.
+        The blocks are memory-mapped, so nothing else is read yet.
+        The mode is as for numpy.memmap: 'r+' to change the sims in place.
+    '''
+    with open(path, 'rb') as fh:
+        magic, hlen = struct.unpack('<4sI', fh.read(8))
+        assert magic == MAGIC, 'not a sim file: {}'.format(path)
+        header = json.loads(fh.read(hlen).decode('utf-8'))
+    rows, cols, full = header['rows'], header['cols'], header['full']
+    order = _block_order(rows, cols, full)
+    blocks = {}
+    if len(order) > 0:
+        data = np.memmap(path, dtype=np.uint8, mode=mode,
+                         offset=_aligned(8 + hlen))
+        offset = 0
+        for (a1, a2) in order:
+            shape = (len(rows[a1]), len(cols[a2]))
+            size = shape[0] * shape[1]
+            blocks[(a1, a2)] = data[offset:offset+size].reshape(shape)
+            offset += size
+    return SimStore(rows, cols, full, blocks)
+
+
+@instrument.timed('read_dat')
+def read_dat(datpath):
+    '''Read a text file of sims, return a list of triples'''
+    metrics = []
+    with open(datpath, 'r') as fh:
+        for line in fh:
+            fn1, fn2, sim = line.split()
+            metrics.append((fn1, fn2, int(sim)))
+    instrument.count('dat lines read', len(metrics))
+    return metrics
+
+
+def patch_store(path, stale, metrics):
+    '''
+        Update the binary file of sims at path: throw away the sims for
+        the stale files (named like XXX-Filename.v), and put in the new
+        triples (file1, file2, similarity), each for at least one stale
+        file, which must be all the sims for the stale files still there.
+        If no student has been added or removed, the file is patched in
+        place; if not, it is written again, but only the blocks for the
+        assignments that have changed are made again.
+    '''
+    store = read_store(path)
+    gone = {}
+    for filename in stale:
+        s, a = _split(filename)
+        gone.setdefault(a, set()).add(s)
+    rows = {a: set(ss) - gone.get(a, set()) for a, ss in store.rows.items()}
+    cols = {a: set(ss) - gone.get(a, set()) for a, ss in store.cols.items()}
+    for fn1, fn2, sim in metrics:
+        _check_sim(fn1, fn2, sim)
+        s1, a1 = _split(fn1)
+        s2, a2 = _split(fn2)
+        rows.setdefault(a1, set()).add(s1)
+        cols.setdefault(a2, set()).add(s2)
+    order = _order(set(rows) | set(cols))
+    rows = {a: sorted(rows[a]) for a in order if len(rows.get(a, ())) > 0}
+    cols = {a: sorted(cols[a]) for a in order if len(cols.get(a, ())) > 0}
+    inplace = (rows == store.rows and cols == store.cols)
+    if inplace:
+        store = read_store(path, mode='r+')
+        blocks = store.blocks
+    else:
+        blocks = {}
+        for (a1, a2) in _block_order(rows, cols, store.full):
+            old = store.blocks.get((a1, a2))
+            if (old is not None and rows[a1] == store.rows[a1]
+                    and cols[a2] == store.cols[a2]):
+                if a1 in gone or a2 in gone:
+                    old = np.array(old)  # A copy, to patch
+                blocks[(a1, a2)] = old
+                continue
+            block = np.full((len(rows[a1]), len(cols[a2])), MISSING,
+                            dtype=np.uint8)
+            if old is not None:  # Keep the sims for the students still there
+                oldrow = {s: i for i, s in enumerate(store.rows[a1])}
+                oldcol = {s: j for j, s in enumerate(store.cols[a2])}
+                keep1 = [(i, oldrow[s]) for i, s in enumerate(rows[a1])
+                         if s in oldrow]
+                keep2 = [(j, oldcol[s]) for j, s in enumerate(cols[a2])
+                         if s in oldcol]
+                block[np.ix_([i for (i, _) in keep1],
+                             [j for (j, _) in keep2])] = \
+                    old[np.ix_([i for (_, i) in keep1],
+                               [j for (_, j) in keep2])]
+            blocks[(a1, a2)] = block
+    # Clear the old sims for the stale students that are still there:
+    for (a1, a2), block in blocks.items():
+        stale1 = [i for i, s in enumerate(rows[a1]) if s in gone.get(a1, ())]
+        stale2 = [j for j, s in enumerate(cols[a2]) if s in gone.get(a2, ())]
+        if len(stale1) > 0:
+            block[stale1, :] = MISSING
+        if len(stale2) > 0:
+            block[:, stale2] = MISSING
+    rownum = {a: {s: i for i, s in enumerate(ss)} for a, ss in rows.items()}
+    colnum = {a: {s: j for j, s in enumerate(ss)} for a, ss in cols.items()}
+    for fn1, fn2, sim in metrics:
+        s1, a1 = _split(fn1)
+        s2, a2 = _split(fn2)
+        if (a1, a2) in blocks:
+            blocks[(a1, a2)][rownum[a1][s1], colnum[a2][s2]] = sim
+    if inplace:
+        for block in blocks.values():
+            block.flush()
+        os.utime(path)  # So it's seen as changed (see load_results)
+    else:
+        # Write a new file, since the blocks left as they were are
+        # still memory-mapped from the old one:
+        newpath = path + '.new'
+        save_store(newpath, SimStore(rows, cols, store.full, blocks))
+        os.replace(newpath, path)
+
+
+def _line_key(line):
+    '''The sort key for a line of a .dat file (see compare.write_results)'''
+    fn1, fn2, _ = line.split(' ')
+    return fn1 + fn2
+
+
+def _find_line(text, key, lo, hi):
+    '''
+        The offset of the first line in text[lo:hi] (which are whole,
+        sorted lines) that key would go before.
+    '''
+    while lo < hi:
+        start = max(lo, text.rfind('\n', lo, (lo + hi) // 2) + 1)
+        end = text.find('\n', start) + 1
+        if _line_key(text[start:end]) < key:
+            lo = end
+        else:
+            hi = start
+    return lo
+
+
+def _stale_lines(text, stale_name):
+    '''Return the (start, end) of each line in text for a stale file'''
+    spans = set()
+    for match in stale_name.finditer(text):
+        s, e = match.span()
+        start = text.rfind('\n', 0, s) + 1
+        # Only a whole name, as the first or second thing on the line:
+        if text[e:e+1] != ' ' or (s != start and (
+                text[s-1] != ' ' or ' ' in text[start:s-1])):
+            continue
+        spans.add((start, text.find('\n', e) + 1 or len(text)))
+    return sorted(spans)
+
+
+def patch_dat(path, stale, metrics, chunk=1 << 22):
+    '''
+        Update the text file of sims at path, as patch_store does.
+        The file is copied (chunk bytes at a time), leaving out the
+        lines for the stale files (found by searching for their names),
+        and since it is sorted, the new triples (once sorted) are merged
+        in as it goes: the lines that are kept are never split up,
+        or sorted again.
+    '''
+    metrics = sorted(metrics, key=lambda t: t[0]+t[1])
+    for fn1, fn2, sim in metrics:
+        _check_sim(fn1, fn2, sim)
+    keys = [fn1 + fn2 for (fn1, fn2, _) in metrics]
+    lines = ['{} {} {}\n'.format(*t) for t in metrics]
+    # Longest first, so a name is never taken for the start of another:
+    stale_name = re.compile('|'.join(
+        re.escape(filename) for filename in sorted(stale, key=len,
+                                                   reverse=True)))
+    newpath = path + '.new'
+    k = 0
+    with open(path, 'r') as old, open(newpath, 'w') as new:
+        while True:
+            text = old.read(chunk)
+            if len(text) == 0:
+                break
+            text += old.readline()  # Finish the last line
+            if len(stale) > 0:
+                kept, start = [], 0
+                for (s, e) in _stale_lines(text, stale_name):
+                    kept.append(text[start:s])
+                    start = e
+                kept.append(text[start:])
+                text = ''.join(kept)
+            if len(text) == 0:
+                continue
+            last = _line_key(text[text.rfind('\n', 0, len(text)-1)+1:])
+            start = 0
+            while k < len(keys) and keys[k] < last:
+                where = _find_line(text, keys[k], start, len(text))
+                new.write(text[start:where])
+                new.write(lines[k])
+                start = where
+                k += 1
+            new.write(text[start:])
+        new.writelines(lines[k:])
+    os.replace(newpath, path)
+
+
+def convert_dat(datpath, simpath=None):
+    '''Convert a text file of sims to the binary format'''
+    if simpath is None:
+        simpath = os.path.splitext(datpath)[0] + defs.SIM_SUFFIX
+    write_store(simpath, read_dat(datpath))
+    return simpath
+
+
+# Results already loaded, indexed by file path, with their mtimes:
+_loaded = {}
+
+
+def load_results(datpath):
+    '''
+        Load the sims for this results file into a SimStore, just once.
+        If there's an up-to-date binary (.sim) version, use that instead.
+        Results are kept in memory, so later calls are free
+        (unless the file has changed since).
+    '''
+    simpath = os.path.splitext(datpath)[0] + defs.SIM_SUFFIX
+    if os.path.isfile(simpath) and (not os.path.isfile(datpath) or
+                                    os.path.getmtime(simpath) >=
+                                    os.path.getmtime(datpath)):
+        path = simpath
+    else:
+        path = datpath
+    mtime = os.path.getmtime(path)
+    if path not in _loaded or _loaded[path][0] != mtime:
+        if path == simpath:
+            store = read_store(path)
+        else:
+            store = make_store(read_dat(path))
+        _loaded[path] = (mtime, store)
+    return _loaded[path][1]
+
+
+def convert_all():
+    '''Convert all the metric-proc and special-metric-proc files'''
+    for metric in defs.ALL_METRICS:
+        for proc in defs.ALL_PROCESS:
+            basename = metric + defs.FILENAME_SEP + proc
+            for datpath in [
+                    os.path.join(defs.RESULTS_DIR, basename+defs.DATA_SUFFIX),
+                    defs.special_filename(metric, proc)]:
+                if os.path.isfile(datpath):
+                    print('Converted', convert_dat(datpath))
+
+
+function = 1
+if __name__ == '__main__':
+    if function == 1:
+        convert_all()
@@ -6,11 +6,12 @@
 '''
 
 import os
-import matplotlib.pyplot as plt
 
 import defs
 import compare
-import plot_graphs
+import figures
+import instrument
+import simstore
 
 
 def copy_specials():
@@ -28,58 +29,81 @@ def copy_specials():
                               omit_first=False)
 
 
-def compare_all(student_dir, special_dir, cmpfunc):
+def compare_all(student_dir, special_dir, cmpfunc, corpus=None,
+                vectorise=True, pool=None, nshards=1, cache=None):
     '''
         Compare the special submission for a program against all students
         Return a list of triples: (file1, file2, similarity).
         This is not NxN but 1xN: special vs all.
+        If vectorise, use the faster versions of the metrics.
+        If given a pool (from compare.start_pool), run in parallel.
+        If given a cache (a paircache.PairCache), use and update it.
     '''
-    _, _, specialfiles = next(os.walk(special_dir))
+    if corpus is None:
+        corpus = compare.Corpus()
+    specialfiles = compare.list_files(special_dir, corpus)
     specialfiles = [f for f in specialfiles if f.endswith(defs.VERILOG_SUFFIX)]
-    _, _, studentfiles = next(os.walk(student_dir))
+    studentfiles = compare.list_files(student_dir, corpus)
     studentfiles = [f for f in studentfiles if f.endswith(defs.VERILOG_SUFFIX)]
-    metrics = []
-    for fn1 in specialfiles:
-        lines1 = compare.read_file(special_dir, fn1)
-        if (not lines1) or len(lines1) == 0:
-            continue
-        for fn2 in studentfiles:  # if symmetric, use files[i+1:]:
-            lines2 = compare.read_file(student_dir, fn2)
-            if (not lines2) or len(lines2) == 0:
-                continue
-            sim = round(cmpfunc(lines1, lines2) * 100)
-            metrics.append((fn1, fn2, sim))
+    if cache is not None:
+        metrics = compare.compare_cached(special_dir, specialfiles,
+                                         student_dir, studentfiles,
+                                         cmpfunc, corpus, cache, vectorise,
+                                         pool, nshards)
+    elif pool is not None:
+        metrics = compare.compare_sharded(special_dir, specialfiles,
+                                          student_dir, studentfiles,
+                                          cmpfunc, pool, nshards, vectorise)
+    else:
+        metrics = compare.compare_block(special_dir, specialfiles,
+                                        student_dir, studentfiles,
+                                        cmpfunc, corpus, vectorise)
     return sorted(metrics, key=lambda t: t[0]+t[1])
 
 
-def do_one_compare(outpath, student_dir, special_dir, cmpfunc):
+def do_one_compare(outpath, student_dir, special_dir, cmpfunc, corpus=None,
+                   vectorise=True, pool=None, nshards=1, cache=None):
     '''
         Compare all programs in datadir, write results to output file.
     '''
-    metrics = compare_all(student_dir, special_dir, cmpfunc)
+    compare.check_fraction(cmpfunc)
+    with instrument.Job(os.path.basename(outpath)) as job:
+        metrics = compare_all(student_dir, special_dir, cmpfunc, corpus,
+                              vectorise, pool, nshards, cache)
+        job.add(len(metrics))
+        instrument.count('pairs scored', len(metrics))
     with open(outpath, 'w') as fh:
         for s1, s2, m in metrics:
             fh.write('{} {} {}\n'.format(s1, s2, m))
     print('Sim values written to {}.'.format(outpath))
 
 
-def compare_specials():
+def compare_specials(workers=1, cache=None, corpus=None):
     '''
         Compare the specials against the student submissions.
         Use all metrics, and do both original and clean.
         Write comparison triples to files: special-metric-proc.dat
+        If workers > 1, run each one in parallel on that many processes.
+        If given a cache (a paircache.PairCache), use and update it.
     '''
-    metrics = {
-        'jaccard': compare.jaccard,
-        'tversky': compare.tv_asymmetric,
-        'sequence': compare.sm_compare
-    }
-    for (metric, cmpfunc) in metrics.items():
+    if corpus is None:
+        corpus = compare.Corpus()
+    pool = None
+    if workers > 1:
+        src_dirs = ([defs.special_dir(proc) for proc in defs.ALL_PROCESS] +
+                    [defs.latest_dir(proc) for proc in defs.ALL_PROCESS])
+        pool = compare.start_pool(corpus, workers, src_dirs)
+    for metric in defs.ALL_METRICS:
+        cmpfunc = compare.METRICS[metric].cmpfunc
         for proc in defs.ALL_PROCESS:
                 special_dir = defs.special_dir(proc)
                 student_dir = defs.latest_dir(proc)
                 outpath = defs.special_filename(metric, proc)
-                do_one_compare(outpath, student_dir, special_dir, cmpfunc)
+                do_one_compare(outpath, student_dir, special_dir, cmpfunc,
+                               corpus, pool=pool, nshards=4 * workers,
+                               cache=cache)
+    if pool is not None:
+        pool.shutdown()
 
 
 def read_special_sim_all(simfile, special_kind):
@@ -88,12 +112,13 @@ def read_special_sim_all(simfile, special_kind):
         So return a dict, mapping assignment to list of sim values,
         for all students doing that assignment (vs specials).
     '''
+    store = simstore.load_results(simfile)
     sims = {k: [] for k in defs.assignments}
-    with open(simfile, 'r') as fh:
-        for line in fh:
-            skind, a1, stu, a2, sim = line.strip().replace('-', ' ').split()
-            if a1 == a2 and skind == special_kind:  # within one project
-                sims[a1].append(int(sim))
+    for a in sims:
+        if (a, a) not in store.blocks or special_kind not in store.rows[a]:
+            continue
+        row = store.block(a)[store.rows[a].index(special_kind)]
+        sims[a] = row[row != simstore.MISSING].tolist()
     # Make sure every project has at least one data point:
     for simvals in sims.values():
         if len(simvals) == 0:
@@ -101,25 +126,28 @@ def read_special_sim_all(simfile, special_kind):
     return sims
 
 
-def plot_special_sims(special_kind, metric, processes):
+def plot_special_sims(special_kind, metric, processes, preview=False):
     '''
         Plot all the violin plots in a single figure.
         Kind and metric are fixed, so three plots (orig/clean/token).
+        The one figure is reused for each plot, and closed at the end.
+        If preview, also save PNG versions (see figures.save).
     '''
     assert special_kind in defs.ALL_SPECIALS, special_kind
     assert metric in defs.ALL_METRICS, metric
+    import plot_graphs  # Only needed for plotting
+    plt = figures.pyplot()
+    fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(7, 5))
     for j, proc in enumerate(processes):
-        fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(7, 5))
+        ax.clear()
         simfile = defs.special_filename(metric, proc)
         sims = read_special_sim_all(simfile, special_kind)
-        basename = defs.FILENAME_SEP.join([special_kind, metric, proc])
         plot_graphs.plot_one_violin(ax, sims, metric, proc)
         # and write to file:
         basename = defs.FILENAME_SEP.join(['violin', special_kind, proc])
-        outfile = os.path.join(defs.GRAPHS_DIR,
-                               basename + defs.GRAPHS_SUFFIX)
-        plt.savefig(outfile, bbox_inches='tight')
+        figures.save(fig, basename, preview, bbox_inches='tight')
         print(' Violin plots written to {}'.format(basename))
+    plt.close(fig)
 
 
 function = 1
@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+'''
+    A compact index of all the submissions: one row per submission,
+    in a numpy structured array (25 bytes a row, instead of a tuple
+    of strings). Each row has the student and assignment as codes
+    (positions in student_ids and assignments), the time in seconds
+    since the epoch, and the job number (and how many digits it had).
+    The rows are kept sorted by student, assignment and time
+    (then by the order they were added), so:
+        - the latest submission for every (student, assignment) is
+          the last row of its group, all found at once by latest()
+        - all of a student's submissions are one slice of the rows
+    The JW filenames are only made again from the rows when needed.
+'''
+
+import itertools
+
+import numpy as np
+
+import defs
+
+SUBMIT_DTYPE = np.dtype([('student', np.int32), ('assignment', np.int32),
+                         ('time', np.int64), ('jobnum', np.int64),
+                         ('jobwidth', np.uint8)])
+
+
+def parse_times(times):
+    '''Convert JW times (YYYY-MM-DD-HH-MM-SS) to seconds since the epoch'''
+    stamps = [t[:10] + 'T' + t[11:].replace(defs.FILENAME_SEP, ':')
+              for t in times]
+    return np.array(stamps, dtype='datetime64[s]').astype(np.int64)
+
+
+def format_times(seconds):
+    '''Convert seconds since the epoch back to JW times'''
+    stamps = np.datetime_as_string(np.asarray(seconds, dtype='datetime64[s]'))
+    return [s.replace('T', defs.FILENAME_SEP).replace(':', defs.FILENAME_SEP)
+            for s in stamps]
+
+
+class SubmissionIndex:
+    '''
+        All the submissions, as a sorted structured array of rows
+        (see SUBMIT_DTYPE), plus the names for the student and
+        assignment codes. Make one with make_index.
+    '''
+    def __init__(self, student_ids, assignments, rows):
+        self.student_ids = student_ids
+        self.assignments = assignments
+        self.rows = rows
+        self.student_code = {s: i for i, s in enumerate(student_ids)}
+        self.assignment_code = {a: i for i, a in enumerate(assignments)}
+        # Student i's rows are rows[starts[i]:starts[i+1]]
+        self.starts = np.searchsorted(rows['student'],
+                                      np.arange(len(student_ids) + 1))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def latest(self):
+        '''Return the rows for the latest submission of each assignment'''
+        rows = self.rows
+        last = np.ones(len(rows), dtype=bool)
+        last[:-1] = ((rows['student'][1:] != rows['student'][:-1]) |
+                     (rows['assignment'][1:] != rows['assignment'][:-1]))
+        return rows[last]
+
+    def submissions(self, student_id, assignment=None):
+        '''
+            Return the rows for this student's submissions (just for one
+            assignment, if given), oldest first.
+        '''
+        code = self.student_code.get(student_id)
+        if code is None:
+            return self.rows[:0]
+        rows = self.rows[self.starts[code]:self.starts[code + 1]]
+        if assignment is not None:
+            rows = rows[rows['assignment'] ==
+                        self.assignment_code.get(assignment, -1)]
+        return rows
+
+    def filenames(self, rows):
+        '''Return the JW filename for each of the rows'''
+        return ['Anon-{}-submit-{}-{:0{}d}{}'.format(
+                    self.student_ids[student], time, jobnum, jobwidth,
+                    defs.JW_FILE_SUFFIX)
+                for student, time, jobnum, jobwidth in zip(
+                    rows['student'], format_times(rows['time']),
+                    rows['jobnum'], rows['jobwidth'])]
+
+    def latest_files(self):
+        '''
+            For the latest version of each file for each student,
+            yield (oldfilename, newfilename), where the new one is
+            XXX-Filename.v (as compare.latest_files does).
+        '''
+        rows = self.latest()
+        for oldfilename, student, assignment in zip(
+                self.filenames(rows), rows['student'], rows['assignment']):
+            yield (oldfilename, self.student_ids[student] +
+                   defs.FILENAME_SEP + self.assignments[assignment])
+
+
+def _make_rows(submits, student_code, assignment_code):
+    '''Make the rows for a list of submits, adding any new codes'''
+    students = [student_code.setdefault(s, len(student_code))
+                for (s, _, _, _) in submits]
+    found = [(student, vfile, time, jobnum)
+             for student, (_, vfile, time, jobnum) in zip(students, submits)
+             if vfile is not None]
+    rows = np.empty(len(found), dtype=SUBMIT_DTYPE)
+    rows['student'] = [student for (student, _, _, _) in found]
+    rows['assignment'] = [assignment_code.setdefault(a, len(assignment_code))
+                          for (_, a, _, _) in found]
+    rows['time'] = parse_times([t for (_, _, t, _) in found])
+    rows['jobnum'] = [int(j) for (_, _, _, j) in found]
+    rows['jobwidth'] = [len(j) for (_, _, _, j) in found]
+    return rows
+
+
+def make_index(submits, chunk=10000):
+    '''
+        Make the index from (student_id, vfile, time, jobnum) tuples
+        (as compare.read_submits yields them), where the time and jobnum
+        are strings, as in the JW filenames. A vfile of None just adds
+        the student, even if they have no submissions.
+        The submits can be a generator: they are made into rows chunk
+        at a time, so a list of them all is never made.
+    '''
+    student_code = {}
+    assignment_code = {}
+    submits = iter(submits)
+    parts = []
+    while True:
+        block = list(itertools.islice(submits, chunk))
+        if len(block) == 0:
+            break
+        parts.append(_make_rows(block, student_code, assignment_code))
+    rows = np.concatenate(parts) if parts else np.empty(0, SUBMIT_DTYPE)
+    # A stable sort, so for equal times the one added last is the latest:
+    order = np.lexsort((rows['time'], rows['assignment'], rows['student']))
+    return SubmissionIndex(list(student_code), list(assignment_code),
+                           rows[order])
@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+'''
+    Normalise Verilog source for comparison, using a compiled-regex lexer.
+    Comments are taken out in one pass over the file, and then each line
+    is cut into tokens by one regex (so most of the work is done in C).
+    Whitespace is dropped; if canonical, identifiers become ID,
+    numbers NUM and strings STR,
+    so renaming variables or changing constants doesn't hide a copy.
+    Keywords, operators, system tasks ($display) and directives stay as is.
+    The result can be either:
+        - lines: each source line's tokens, separated by single spaces
+        - shingles: each run of n tokens (ignoring line breaks)
+    Either one is a list of strings, so the metrics can use them as lines.
+'''
+
+import re
+
+KEYWORDS = frozenset('''
+    always and assign automatic begin buf bufif0 bufif1 case casex casez
+    cell cmos config deassign default defparam design disable edge else
+    end endcase endconfig endfunction endgenerate endmodule endprimitive
+    endspecify endtable endtask event for force forever fork function
+    generate genvar highz0 highz1 if ifnone incdir include initial inout
+    input instance integer join large liblist library localparam macromodule
+    medium module nand negedge nmos nor noshowcancelled not notif0 notif1 or
+    output parameter pmos posedge primitive pull0 pull1 pulldown pullup
+    pulsestyle_onevent pulsestyle_ondetect rcmos real realtime reg release
+    repeat rnmos rpmos rtran rtranif0 rtranif1 scalared showcancelled signed
+    small specify specparam strong0 strong1 supply0 supply1 table task time
+    tran tranif0 tranif1 tri tri0 tri1 triand trior trireg unsigned use
+    vectored wait wand weak0 weak1 while wire wor xnor xor
+'''.split())
+
+# Comments, and strings (which might contain '//' or '/*'):
+_COMMENT_OR_STRING = re.compile(r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\\n])*"',
+                                re.DOTALL)
+
+# One token: the order matters, based numbers before numbers,
+# and longer operators before their prefixes.
+_TOKEN = re.compile(r'''
+    "(?:\\.|[^"\\\n])*"                                # string
+  | (?:\d[\d_]*\s*)?'[sS]?[bBoOdDhH]\s*[0-9a-fA-FxXzZ?_]+  # based number
+  | \d[\d_]*(?:\.\d[\d_]*)?(?:[eE][+-]?\d+)?            # number
+  | [$`]?[A-Za-z_][\w$]*                               # name/task/directive
+  | \\\S+                                              # escaped name
+  | <<<|>>>|===|!==|==|!=|<=|>=|&&|\|\||~&|~\||~\^|\^~|<<|>>|\*\*
+  | ->|\+:|-:
+  | \S
+''', re.VERBOSE)
+
+# Canonical form of each token seen so far:
+_canonical = {}
+
+
+def canonical_token(token):
+    '''Map identifiers to ID, numbers to NUM, strings to STR'''
+    first = token[0]
+    if first == '"':
+        return 'STR'
+    if first.isdigit() or first == "'":
+        return 'NUM'
+    if first.isalpha() or first in '_\\':
+        return token if token in KEYWORDS else 'ID'
+    return token  # Operators, system tasks, directives
+
+
+def _strip_comments(text):
+    '''Remove comments, but keep their line breaks'''
+    def _blank_comment(m):
+        text = m.group(0)
+        if text.startswith('"'):
+            return text
+        return '\n' * text.count('\n')
+    return _COMMENT_OR_STRING.sub(_blank_comment, text)
+
+
+def strip_comments(lines):
+    '''Remove the comments from the lines, and any lines left empty'''
+    stripped = [line.rstrip()
+                for line in _strip_comments('\n'.join(lines)).split('\n')]
+    return [line for line in stripped if len(line.strip()) > 0]
+
+
+def _line_tokens(lines, canonical):
+    '''Return the list of tokens for each line'''
+    lines = _strip_comments('\n'.join(lines)).split('\n')
+    findall = _TOKEN.findall
+    if not canonical:
+        return [findall(line) for line in lines]
+    canon = _canonical
+    result = []
+    for line in lines:
+        tokens = findall(line)
+        try:
+            result.append([canon[t] for t in tokens])
+        except KeyError:  # Some new tokens: work them out, and try again
+            for t in tokens:
+                if t not in canon:
+                    canon[t] = canonical_token(t)
+            result.append([canon[t] for t in tokens])
+    return result
+
+
+def lex(text, canonical=True):
+    '''
+        Yield (line number, token) for each token in the text,
+        counting lines from 0. Comments and whitespace are skipped.
+    '''
+    for lineno, tokens in enumerate(_line_tokens(text.split('\n'),
+                                                 canonical)):
+        for token in tokens:
+            yield (lineno, token)
+
+
+def token_lines(lines, canonical=True):
+    '''
+        Return the tokens of each (non-empty) line,
+        separated by single spaces.
+    '''
+    return [' '.join(tokens) for tokens in _line_tokens(lines, canonical)
+            if tokens]
+
+
+def shingles(tokens, n):
+    '''
+        Return each run of n tokens, as a string.
+        A list shorter than n gives just one (short) shingle.
+    '''
+    if len(tokens) <= n:
+        return [' '.join(tokens)] if tokens else []
+    return [' '.join(gram) for gram in zip(*[tokens[i:] for i in range(n)])]
+
+
+def token_shingles(lines, n=3, canonical=True):
+    '''Return the n-token shingles of the source'''
+    return shingles([token for tokens in _line_tokens(lines, canonical)
+                     for token in tokens], n)
+
+
+def tokenizer(ngram=None, canonical=True):
+    '''
+        Return a function mapping lines to lines, to use in preprocess:
+        if ngram is None, one line of tokens per source line,
+        otherwise the ngram-token shingles.
+    '''
+    if ngram is None:
+        return lambda lines: token_lines(lines, canonical)
+    return lambda lines: token_shingles(lines, ngram, canonical)
+
+
+class TokenIndex:
+    '''
+        Give every distinct token (or shingle) an integer ID,
+        numbered from 0 as they are first seen.
+    '''
+    def __init__(self):
+        self.ids = {}
+        self.tokens = []
+
+    def intern(self, tokens):
+        '''Return the list of IDs for these tokens'''
+        ids = self.ids
+        result = []
+        for token in tokens:
+            tid = ids.get(token)
+            if tid is None:
+                tid = ids[token] = len(self.tokens)
+                self.tokens.append(token)
+            result.append(tid)
+        return result
+
+
+def token_ids(lines, index, canonical=True):
+    '''Return the (interned) token IDs for the source'''
+    return index.intern(token for tokens in _line_tokens(lines, canonical)
+                        for token in tokens)